@@ -1,4 +1,11 @@
 from .client import *
 from .rcfile import *
 from .locator import *
+from .pool import *
 
+from .shard import *
+from .table import *
+from .chains import *
+from .search import *
+from .export import *
+from .metrics import *
@@ -0,0 +1,541 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the asyncio version of the client. It speaks
+# exactly the same protocol as discuss.client and reuses its USP encoding, the
+# only difference being that the connection is an asyncio stream, so that a
+# single event loop can talk to many servers at once instead of dedicating an
+# OS thread to every blocking socket.
+#
+# Example:
+#
+#     async def main():
+#         cl = await AsyncClient.connect("charon.mit.edu")
+#         mtg = AsyncMeeting(cl, "/var/spool/discuss/vasilvv-test")
+#         async for trn in mtg.transactions():
+#             print(trn.number, trn.subject)
+#             print(await trn.get_text())
+#         cl.close()
+#
+
+import asyncio
+import codecs
+import io
+import socket
+
+from .rpc import USPBlock, ProtocolError, USPReader, make_auth_block, spawn_local_server
+from .client import DiscussError, Transaction, _read_mtg_info, _read_transaction, \
+        _make_post_request, _read_post_reply, _make_text_request, _read_text_reply, \
+        _check_text_reply, _SKIPPED_TRN_ERRORS
+from .pipeline import make_window
+from . import constants, records
+from collections import deque
+
+class _ConnectionLock(object):
+    """Lock which gives a coroutine the exclusive use of the connection.
+    Taking it first reads out the replies to the requests that pipelines
+    (see AsyncMeeting.transactions()) have in flight, so that the holder
+    can send a request and read its reply as usual."""
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.mutex = asyncio.Lock()
+
+    def locked(self):
+        return self.mutex.locked()
+
+    async def __aenter__(self):
+        await self.mutex.acquire()
+        try:
+            while self.rpc.in_flight:
+                await self.rpc.receive_in_flight()
+        except:
+            self.mutex.release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.mutex.release()
+
+class AsyncRPCClient(object):
+    """RPC connection over an asyncio stream. Use open() to create one."""
+
+    def __init__(self, server, port, auth = True, timeout = None):
+        self.server = server
+        self.port = port
+        self.auth = auth
+        self.timeout = timeout
+
+        # Requests and their replies are matched by order, so only one
+        # coroutine may use the connection at a time
+        self.lock = _ConnectionLock(self)
+        # Pipelined requests whose replies have not been read yet: for each,
+        # the queue its reply goes into
+        self.in_flight = deque()
+
+    @classmethod
+    async def open(cls, server, port = 2100, auth = True, timeout = None):
+        rpc = cls(server, port, auth, timeout)
+        await rpc.connect()
+        return rpc
+
+    async def open_streams(self):
+        return await asyncio.wait_for(
+                asyncio.open_connection(self.server, self.port), self.timeout)
+
+    async def connect(self):
+        # The name lookup is blocking, so it is done in the default executor
+        loop = asyncio.get_running_loop()
+        self.server = (await loop.run_in_executor(None, socket.getfqdn, self.server)).lower()
+
+        self.stream_reader, self.stream_writer = await self.open_streams()
+        sock = self.stream_writer.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = USPReader()
+
+        auth_block = make_auth_block(self.server, self.auth)
+        self.queue(auth_block)
+        await self.flush()
+
+    def queue(self, block):
+        """Adds the block to the transport's write buffer. Nothing is sent
+        until the event loop runs, so the pipelined requests are coalesced by
+        the transport."""
+
+        self.stream_writer.writelines(block.encode())
+
+    async def flush(self):
+        await self.stream_writer.drain()
+
+    async def send(self, block):
+        self.queue(block)
+        await self.flush()
+
+    async def fill(self):
+        space = self.reader.writable()
+        data = await asyncio.wait_for(self.stream_reader.read(len(space)), self.timeout)
+        if not data:
+            raise ProtocolError("Connection broken while transmitting a block")
+        space[0:len(data)] = data
+        self.reader.commit(len(data))
+
+    async def receive(self):
+        await self.flush()
+        block = self.reader.next_block()
+        while block is None:
+            await self.fill()
+            block = self.reader.next_block()
+        return block
+
+    def queue_in_flight(self, block, replies):
+        """Queues a pipelined request; its reply will be appended to the
+        replies queue by receive_in_flight(). The caller must hold the
+        connection mutex (lock.mutex)."""
+
+        self.queue(block)
+        self.in_flight.append(replies)
+
+    async def receive_in_flight(self):
+        """Reads the reply to the oldest pipelined request into its queue.
+        The caller must hold the connection mutex. If the queue is no
+        longer read (its pipeline was cancelled or abandoned), the reply is
+        simply dropped with it."""
+
+        reply = await self.receive()
+        self.in_flight.popleft().append(reply)
+
+    async def receive_subblock(self):
+        """Returns the next subblock as a (block type, payload, last) tuple,
+        without assembling the block. The payload is a memoryview into the
+        read buffer, and is only valid until the next call."""
+
+        await self.flush()
+        subblock = self.reader.next_subblock()
+        while subblock is None:
+            await self.fill()
+            subblock = self.reader.next_subblock()
+        return subblock
+
+    async def request(self, block):
+        block.block_type += constants.PROC_BASE
+        self.queue(block)
+        reply = await self.receive()
+        if reply.block_type != constants.REPLY_TYPE:
+            raise ProtocolError("Transport-level error")
+        return reply
+
+    def close(self):
+        self.stream_writer.close()
+
+class AsyncRPCLocalClient(AsyncRPCClient):
+    """Asynchronous version of RPCLocalClient, which runs disserve locally."""
+
+    def __init__(self, server, port, auth = True, timeout = None):
+        # Used as the id field on meeting objects, so copy it in
+        self.server = server
+        # port 2100 is the default port -> use the binary
+        if port == 2100:
+            port = '/usr/sbin/disserve'
+        self.cmd = port
+        self.port = port
+        self.auth = auth
+        self.timeout = timeout
+        self.lock = _ConnectionLock(self)
+        self.in_flight = deque()
+
+    async def open_streams(self):
+        return await asyncio.open_connection(sock = spawn_local_server(self.cmd))
+
+    async def connect(self):
+        self.stream_reader, self.stream_writer = await self.open_streams()
+        self.reader = USPReader()
+
+class AsyncClient(object):
+    """Asynchronous discuss client. Use connect() to create one."""
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    @classmethod
+    async def connect(cls, server, port = 2100, auth = True, timeout = None, RPCClient = AsyncRPCClient):
+        client = cls(await RPCClient.open(server, port, auth, timeout))
+        if auth and (await client.who_am_i()).startswith("???@"):
+            client.close()
+            raise ProtocolError("Authentication to server failed")
+        return client
+
+    async def get_server_version(self):
+        """Ask server for the server version number"""
+
+        request = USPBlock(constants.GET_SERVER_VERSION)
+        async with self.rpc.lock:
+            reply = await self.rpc.request(request)
+        version, = records.SERVER_VERSION_REPLY.unpack(reply)
+        return version
+
+    async def who_am_i(self):
+        """Ask server for the Kerberos principal with which discuss identified
+        the client after the handshake."""
+
+        request = USPBlock(constants.WHO_AM_I)
+        async with self.rpc.lock:
+            reply = await self.rpc.request(request)
+        principal, = records.WHO_AM_I_REPLY.unpack(reply)
+        return principal
+
+    async def create_mtg(self, location, long_mtg_name, public):
+        request = USPBlock(constants.CREATE_MTG)
+        records.CREATE_MTG_REQUEST.pack(request, location, long_mtg_name, public)
+        async with self.rpc.lock:
+            reply = await self.rpc.request(request)
+        result, = records.RESULT.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
+
+    def close(self):
+        """Disconnect from the server."""
+
+        self.rpc.close()
+
+class AsyncMeeting(object):
+    """Discuss meeting accessed through AsyncClient."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.rpc = client.rpc
+        self.name = name
+        self.short_name = name.split('/')[-1]
+        self.id = (self.rpc.server, name)
+        self.info_loaded = False
+
+    async def _call(self, request):
+        async with self.rpc.lock:
+            return await self.rpc.request(request)
+
+    async def load_info(self, force = False):
+        """Load all the properties into the class."""
+
+        if self.info_loaded and not force:
+            return
+
+        request = USPBlock(constants.GET_MTG_INFO)
+        records.MTG_NAME.pack(request, self.name)
+        reply = await self._call(request)
+        self.__dict__.update(_read_mtg_info(reply))
+
+        self.info_loaded = True
+
+    async def check_update(self, last):
+        """Check whether the meeting has updated since last time we looked at it.
+        Returns true if given last < real last, false if they are equal and error
+        if given is greater than real."""
+
+        request = USPBlock(constants.UPDATED_MTG)
+        records.UPDATED_MTG_REQUEST.pack(request, self.name, 0, last)
+        reply = await self._call(request)
+        updated, result = records.UPDATED_MTG_REPLY.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
+
+        return updated
+
+    def request_transaction(self, number, replies = None):
+        """Queue the request for the transaction. The caller must hold the
+        connection lock; if the replies queue is given, the request is
+        pipelined (see AsyncRPCClient.queue_in_flight()) and the caller
+        must hold the connection mutex instead."""
+
+        request = USPBlock(constants.PROC_BASE + constants.GET_TRN_INFO3)
+        records.TRN_NUMBER.pack(request, self.name, number)
+        if replies is None:
+            self.rpc.queue(request)
+        else:
+            self.rpc.queue_in_flight(request, replies)
+
+    async def receive_transaction(self):
+        """Read the transaction from the connection. The caller must hold the
+        connection lock."""
+
+        reply = await self.rpc.receive()
+        return _read_transaction(self, reply, AsyncTransaction)
+
+    async def get_transaction(self, number):
+        """Retrieve the informataion about a transaction using the number."""
+
+        async with self.rpc.lock:
+            self.request_transaction(number)
+            return await self.receive_transaction()
+
+    async def transactions(self, start = 1, end = -1, feedback = None, window = None):
+        """Asynchronous iterator over the given range of transactions, with
+        the requests pipelined the same way Meeting.iter_transactions() does.
+        Without arguments, iterates over all transactions.
+
+        The connection is not held while a transaction is yielded, so the
+        body of the loop may use the meeting (e.g. await trn.get_text()):
+        taking the connection lock reads out the replies in flight first,
+        and the iteration then continues where it stopped. If the iteration
+        is cancelled or abandoned, its replies are read out and dropped by
+        the next user of the connection."""
+
+        if end == -1:
+            await self.load_info()
+            end = self.last
+
+        total = end - start + 1
+        to_request = total
+        to_read = total
+        flow = make_window(window, self.rpc.stream_writer.get_extra_info('socket'))
+        self.pipeline_stats = flow.stats
+        cur = start
+        replies = deque()
+
+        while to_read != 0:
+            # The window is refilled as every reply arrives
+            if not replies or (to_request > 0 and to_read - to_request < flow.window):
+                async with self.rpc.lock.mutex:
+                    while to_request > 0 and to_read - to_request < flow.window:
+                        self.request_transaction(cur, replies)
+                        flow.sent()
+                        cur += 1
+                        to_request -= 1
+
+                    # The replies to the pipelines started earlier come first
+                    while not replies:
+                        await self.rpc.receive_in_flight()
+
+            reply = replies.popleft()
+            flow.received(len(reply.buffer))
+            left = to_read
+            to_read -= 1
+
+            try:
+                trn = _read_transaction(self, reply, AsyncTransaction)
+            except DiscussError as err:
+                if err.code not in _SKIPPED_TRN_ERRORS:
+                    raise err
+                continue
+
+            if feedback:
+                feedback(cur = trn.number, total = total, left = left)
+            yield trn
+
+    async def post(self, text, subject, signature = None, reply_to = 0):
+        """Add a transaction to the meeting."""
+
+        request, tfile = _make_post_request(self.name, text, subject, signature, reply_to)
+        async with self.rpc.lock:
+            self.rpc.queue(request)
+            self.rpc.queue(tfile)
+            reply = await self.rpc.receive()
+        new_id = _read_post_reply(reply)
+
+        return await self.get_transaction(new_id)
+
+    async def get_acl(self):
+        """Retrieve the access list of the meeting. Returns the list
+        of principal-access tuples."""
+
+        request = USPBlock(constants.GET_ACL)
+        records.MTG_NAME.pack(request, self.name)
+        reply = await self._call(request)
+
+        result, length = records.ACL_REPLY.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
+
+        acl = []
+        for i in range(length):
+            modes, principal = records.ACL_ENTRY.unpack(reply)
+            acl.append( (principal, modes) )
+
+        return acl
+
+    async def get_access(self, principal):
+        """Retrieve the access mode of a given Kerberos principal."""
+
+        request = USPBlock(constants.GET_ACCESS)
+        records.GET_ACCESS_REQUEST.pack(request, self.name, principal)
+        reply = await self._call(request)
+
+        modes, result = records.GET_ACCESS_REPLY.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
+
+        return modes
+
+    async def set_access(self, principal, modes):
+        """Changes the access mode of the given principal."""
+
+        request = USPBlock(constants.SET_ACCESS)
+        records.SET_ACCESS_REQUEST.pack(request, self.name, principal, modes)
+        reply = await self._call(request)
+
+        result, = records.RESULT.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
+
+    async def ensure_access(self, principal, modes):
+        current = await self.get_access(principal)
+        await self.set_access(principal, current+modes)
+
+    async def remove_access(self, principal, modes):
+        current = await self.get_access(principal)
+        new_modes = ''.join(c for c in current if not c in modes)
+        await self.set_access(principal, new_modes)
+
+    async def undelete_transaction(self, trn_number):
+        """Undelete the transaction by its number."""
+
+        request = USPBlock(constants.RETRIEVE_TRN)
+        records.TRN_NUMBER.pack(request, self.name, trn_number)
+        reply = await self._call(request)
+
+        result, = records.RESULT.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
+
+class AsyncTransaction(Transaction):
+    """Discuss transaction returned by AsyncMeeting. The header is the same as
+    the one of Transaction, the methods which talk to the server are
+    coroutines."""
+
+    __slots__ = ()
+
+    async def get_text(self):
+        """Retrieve the text of the transaction."""
+
+        async with self.rpc.lock:
+            self.rpc.queue(_make_text_request(self.meeting.name, self.number))
+            tfile = await self.rpc.receive()
+            if tfile.block_type == constants.REPLY_TYPE:
+                # The server may report an error without sending any text
+                tfile, reply = None, tfile
+            else:
+                reply = await self.rpc.receive()
+        return _read_text_reply(tfile, reply)
+
+    async def aiter_text(self, binary = False):
+        """Asynchronous iterator over the text of the transaction in pieces,
+        as they arrive from the server, the same way Transaction.iter_text()
+        does. The connection lock is held until the iteration is over, so
+        the body of the loop must not use the connection. If the iteration
+        is stopped early, the rest of the response is read out."""
+
+        async with self.rpc.lock:
+            self.rpc.queue(_make_text_request(self.meeting.name, self.number))
+            block_type, payload, last = await self.rpc.receive_subblock()
+
+            if block_type == constants.REPLY_TYPE:
+                # The server may report an error without sending any text
+                reply = USPBlock(block_type)
+                reply.buffer = bytearray(payload)
+                while not last:
+                    block_type, payload, last = await self.rpc.receive_subblock()
+                    reply.buffer += payload
+                _check_text_reply(reply)
+                raise ProtocolError("Bad server response when retriving transaction contents")
+
+            text_type = block_type
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            try:
+                while True:
+                    if text_type == constants.TFILE_BLK:
+                        chunk = payload.tobytes() if binary else decoder.decode(payload, last)
+                        if chunk:
+                            yield chunk
+                    if last:
+                        break
+                    block_type, payload, last = await self.rpc.receive_subblock()
+            except GeneratorExit:
+                # Read out the rest of the response, so that the connection
+                # stays usable
+                while not last:
+                    block_type, payload, last = await self.rpc.receive_subblock()
+                await self.rpc.receive()
+                raise
+            except BaseException:
+                # Stopped in the middle of a block (e.g. cancelled); there is
+                # no telling where the next reply starts
+                self.rpc.close()
+                raise
+
+            reply = await self.rpc.receive()
+
+        _check_text_reply(reply)
+        if text_type != constants.TFILE_BLK:
+            raise ProtocolError("Bad server response when retriving transaction contents")
+
+    def iter_text(self, binary = False):
+        """Same as aiter_text(); the iterator is asynchronous."""
+
+        return self.aiter_text(binary)
+
+    async def write_text(self, target):
+        """Write the text of the transaction into the file object as it
+        arrives (see aiter_text()), the same way Transaction.write_text()
+        does. Returns the amount of data written."""
+
+        binary = isinstance(target, (io.RawIOBase, io.BufferedIOBase))
+        written = 0
+        chunks = self.aiter_text(binary)
+        try:
+            async for chunk in chunks:
+                target.write(chunk)
+                written += len(chunk)
+        finally:
+            await chunks.aclose()
+        return written
+
+    async def delete(self):
+        """Delete the transaction."""
+
+        request = USPBlock(constants.DELETE_TRN)
+        records.TRN_NUMBER.pack(request, self.meeting.name, self.number)
+        async with self.rpc.lock:
+            reply = await self.rpc.request(request)
+
+        result, = records.RESULT.unpack(reply)
+        if result != 0:
+            raise DiscussError(result)
@@ -0,0 +1,280 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements recording of the client's traffic and
+# playing it back without a server. A Capture is attached to RPCClient (the
+# capture attribute, like metrics); it wraps the socket wrapper of every
+# connection and writes everything sent and received into a capture file,
+# with the time it happened.
+#
+# The capture file starts with a magic line, followed by records, each made
+# of a header (record kind, connection number, time in seconds since the
+# start of the capture, data length) and the data. Connection records carry
+# the server name; data records carry the bytes exactly as they went over the
+# socket, so the USP blocks can be parsed out of them afterwards (see
+# read_blocks()).
+#
+# Replay feeds the received data of the recorded connections back to a
+# client, in place of RPCClient. The client has to make the same requests in
+# the same order as the recorded one did; what it sends is not checked. (The
+# order in which Meeting.get_texts() mixes header and text requests depends
+# on the pipelining window, so it has to use a fixed window.) The replies
+# are delivered either as fast as they are read, or with the delays they
+# originally had after the preceding request.
+#
+# Example:
+#
+#     capture = Capture("session.uspcap")
+#     cl = Client("charon.mit.edu", RPCClient = capture.client_class())
+#     ... work with the client ...
+#     capture.close()
+#
+#     cl = Client("charon.mit.edu", RPCClient = Replay("session.uspcap"))
+#
+
+from collections import deque
+from struct import Struct
+import threading
+import time
+
+from .rpc import RPCClient, USPReader, ProtocolError
+
+_MAGIC = b"USPCAP1\n"
+_RECORD = Struct("!BHdI")
+
+CONNECTED = 1
+SENT = 2
+RECEIVED = 3
+
+class Capture(object):
+    """Writer of a capture file. Safe to share between connections and
+    threads."""
+
+    def __init__(self, location):
+        self.location = location
+        self.target = open(location, "wb")
+        self.target.write(_MAGIC)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.connections = 0
+
+    def record(self, kind, connection, data):
+        with self.lock:
+            self.target.write(_RECORD.pack(kind, connection, time.time() - self.started, len(data)))
+            self.target.write(data)
+
+    def wrap(self, wrapper):
+        """Returns the socket wrapper which records the traffic of the given
+        one. Called by RPCClient.make_wrapper()."""
+
+        with self.lock:
+            self.connections += 1
+            connection = self.connections
+        return CaptureWrapper(self, wrapper, connection)
+
+    def client_class(self, base = RPCClient):
+        """Returns a subclass of the given RPC client class whose connections
+        are recorded into this capture."""
+
+        return type("Capturing" + base.__name__, (base,), { 'capture' : self })
+
+    def flush(self):
+        with self.lock:
+            self.target.flush()
+
+    def close(self):
+        with self.lock:
+            self.target.close()
+
+class CaptureWrapper(object):
+    """Socket wrapper which records the data it passes through."""
+
+    def __init__(self, capture, wrapper, connection):
+        self.capture = capture
+        self.wrapper = wrapper
+        self.connection = connection
+
+    def connected(self, server):
+        self.capture.record(CONNECTED, self.connection, server.encode())
+
+    def recv(self, *args, **kwargs):
+        data = self.wrapper.recv(*args, **kwargs)
+        if data:
+            self.capture.record(RECEIVED, self.connection, data)
+        return data
+
+    def recv_into(self, buffer, *args, **kwargs):
+        received = self.wrapper.recv_into(buffer, *args, **kwargs)
+        if received:
+            self.capture.record(RECEIVED, self.connection, memoryview(buffer)[:received].tobytes())
+        return received
+
+    def sendmsg(self, buffers, *args, **kwargs):
+        sent = self.wrapper.sendmsg(buffers, *args, **kwargs)
+
+        # Only record what actually went out, which might end in the middle
+        # of a buffer
+        data = []
+        left = sent
+        for buffer in buffers:
+            if left <= 0:
+                break
+            piece = memoryview(buffer)[:left]
+            data.append(piece)
+            left -= len(piece)
+        self.capture.record(SENT, self.connection, b"".join(data))
+        return sent
+
+    def sendall(self, data, *args, **kwargs):
+        result = self.wrapper.sendall(data, *args, **kwargs)
+        self.capture.record(SENT, self.connection, bytes(data))
+        return result
+
+def read_capture(location):
+    """Iterate over the records of the capture file, as (kind, connection,
+    time, data) tuples."""
+
+    with open(location, "rb") as source:
+        if source.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not a USP capture file" % location)
+
+        while True:
+            header = source.read(_RECORD.size)
+            if not header:
+                return
+            if len(header) < _RECORD.size:
+                raise ValueError("Truncated capture record")
+            kind, connection, timestamp, length = _RECORD.unpack(header)
+            data = source.read(length)
+            if len(data) < length:
+                raise ValueError("Truncated capture record")
+            yield kind, connection, timestamp, data
+
+def read_blocks(location):
+    """Iterate over the USP blocks in the capture, as (connection, kind,
+    time, block) tuples, where kind is SENT or RECEIVED and time is the time
+    at which the last byte of the block went through."""
+
+    readers = {}
+    for kind, connection, timestamp, data in read_capture(location):
+        if kind == CONNECTED:
+            readers[connection, SENT] = USPReader()
+            readers[connection, RECEIVED] = USPReader()
+            continue
+
+        reader = readers[connection, kind]
+        while data:
+            space = reader.writable()
+            size = min(len(space), len(data))
+            space[:size] = data[:size]
+            reader.commit(size)
+            data = data[size:]
+
+            block = reader.next_block()
+            while block is not None:
+                yield connection, kind, timestamp, block
+                block = reader.next_block()
+
+class ReplaySocket(object):
+    """Socket which returns the recorded data of one connection."""
+
+    def __init__(self, events, timing = False):
+        self.timing = timing
+
+        # Every received piece is paired with its delay after the data sent
+        # before it, which is what the replay reproduces
+        self.pending = deque()
+        last_sent = events[0][1] if events else 0.0
+        for kind, timestamp, data in events:
+            if kind == SENT:
+                last_sent = timestamp
+            elif kind == RECEIVED:
+                self.pending.append((timestamp - last_sent, data))
+
+        self.last_sent = time.time()
+        self.closed = False
+
+    def _next_piece(self, size):
+        if not self.pending or self.closed:
+            return b""
+
+        delay, data = self.pending[0]
+        if self.timing:
+            wait = self.last_sent + delay - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+        if size and size < len(data):
+            # The rest is delivered without further delay
+            self.pending[0] = (0.0, data[size:])
+            return data[:size]
+        self.pending.popleft()
+        return data
+
+    def recv(self, size, *args):
+        return self._next_piece(size)
+
+    def recv_into(self, buffer, size = 0, *args):
+        view = memoryview(buffer)
+        data = self._next_piece(min(size, len(view)) if size else len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def sendmsg(self, buffers, *args):
+        self.last_sent = time.time()
+        return sum(len(memoryview(buffer)) for buffer in buffers)
+
+    def sendall(self, data, *args):
+        self.last_sent = time.time()
+
+    def close(self):
+        self.closed = True
+
+class Replay(object):
+    """Plays the recorded connections back. Used in place of the RPCClient
+    class; every connection opened (or reopened) takes the next recorded
+    one, in the order they were opened."""
+
+    def __init__(self, location, timing = False):
+        self.timing = timing
+        self.lock = threading.Lock()
+
+        sessions = {}
+        self.sessions = deque()
+        for kind, connection, timestamp, data in read_capture(location):
+            if kind == CONNECTED:
+                session = (data.decode(), [])
+                sessions[connection] = session
+                self.sessions.append(session)
+            else:
+                sessions[connection][1].append((kind, timestamp, data))
+
+    def next_session(self):
+        with self.lock:
+            if not self.sessions:
+                raise ProtocolError("No more recorded connections to replay")
+            return self.sessions.popleft()
+
+    def __call__(self, server, port = 2100, auth = True, timeout = None):
+        return ReplayRPCClient(self, server, port, auth, timeout)
+
+class ReplayRPCClient(RPCClient):
+    """RPC client whose connections are played back from a capture."""
+
+    def __init__(self, replay, server, port, auth = True, timeout = None):
+        self.replay = replay
+        self.server = server
+        self.port = port
+        self.auth = auth
+        self.timeout = timeout
+
+        self.make_wrapper()
+        self.connect()
+
+    def connect(self):
+        # The recorded connection already contains the authentication
+        server, events = self.replay.next_session()
+        self.server = server
+        self.socket = ReplaySocket(events, self.replay.timing)
+        self.reset_state()
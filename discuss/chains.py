@@ -0,0 +1,109 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the index of reply chains. In discuss, a reply
+# is appended to the chain of the transaction it replies to, and every
+# transaction header points at the previous and next transactions of its
+# chain (pref and nref) and at the first and last ones (fref and lref). Since
+# fref is the same for all the members of a chain, it identifies the chain,
+# and grouping the headers by it is enough to rebuild all the threads in a
+# single pass.
+#
+# Example:
+#
+#     index = ChainIndex(mtg.iter_transactions())
+#     for root in index.roots():
+#         print(root, len(index.thread(root)))
+#
+
+from bisect import bisect_left, insort
+
+class ChainIndex(object):
+    """Index of the reply chains of a meeting. All the transactions are
+    referred to by their numbers."""
+
+    def __init__(self, headers = ()):
+        self.chain_of = {}      # Transaction number -> fref of its chain
+        self.chains = {}        # fref -> sorted list of the numbers in the chain
+        self.keys = []          # Sorted list of the frefs
+        self.update(headers)
+
+    @classmethod
+    def from_table(cls, table):
+        """Build the index out of a TransactionTable."""
+
+        index = cls()
+        for number, fref in zip(table.column('current'), table.column('fref')):
+            index.add(number, fref)
+        return index
+
+    def add(self, number, fref):
+        """Add the transaction with the given number to the chain starting at
+        fref. Transactions may be added in any order, but adding them in the
+        order of numbers is the fastest."""
+
+        if number in self.chain_of:
+            return
+        if not fref:
+            fref = number
+        self.chain_of[number] = fref
+
+        chain = self.chains.get(fref)
+        if chain is None:
+            self.chains[fref] = [number]
+            if self.keys and fref < self.keys[-1]:
+                insort(self.keys, fref)
+            else:
+                self.keys.append(fref)
+        elif number > chain[-1]:
+            chain.append(number)
+        else:
+            insort(chain, number)
+
+    def update(self, headers):
+        """Add the transactions, given either as Transaction objects or as
+        dictionaries of header fields (see Meeting.iter_headers())."""
+
+        for header in headers:
+            if isinstance(header, dict):
+                self.add(header['current'], header['fref'])
+            else:
+                self.add(header.number, header.fref)
+
+    def __len__(self):
+        return len(self.chain_of)
+
+    def __contains__(self, number):
+        return number in self.chain_of
+
+    def thread(self, number):
+        """Returns the list of the transactions in the chain of the given
+        one, in order."""
+
+        return list(self.chains[self.chain_of[number]])
+
+    def root(self, number):
+        """Returns the first known transaction of the chain of the given one."""
+
+        return self.chains[self.chain_of[number]][0]
+
+    def roots(self):
+        """Returns the first transaction of every chain, in order."""
+
+        return [self.chains[fref][0] for fref in self.keys]
+
+    def parent(self, number):
+        """Returns the transaction preceding the given one in its chain, or
+        None if it is the first one."""
+
+        chain = self.chains[self.chain_of[number]]
+        position = bisect_left(chain, number)
+        return chain[position - 1] if position > 0 else None
+
+    def replies(self, number):
+        """Returns the list of the transactions after the given one in its
+        chain."""
+
+        chain = self.chains[self.chain_of[number]]
+        return chain[bisect_left(chain, number) + 1:]
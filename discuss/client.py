@@ -5,11 +5,16 @@
 # See LICENSE file for more details.
 #
 
-from .rpc import USPBlock, RPCClient, ProtocolError
-from . import constants
+from .rpc import USPBlock, RPCClient, ProtocolError, ConnectionBusy
+from .pipeline import AdaptiveWindow, make_window
+from . import constants, records
 
 from functools import total_ordering, wraps
+from collections import deque
+import codecs
 import datetime
+import io
+import itertools
 import socket
 
 class DiscussError(Exception):
@@ -29,10 +34,171 @@ def autoreconnects(f):
         try:
             return f(self, *args, **kwargs)
         except socket.timeout:
+            metrics = getattr(self.rpc, 'metrics', None)
+            if metrics is not None:
+                metrics.timed_out()
             self.rpc.connect()
             return f(self, *args, **kwargs)
     return autoreconnect
 
+def _read_mtg_info(reply):
+    """Decodes the GET_MTG_INFO reply into a dictionary of meeting properties."""
+
+    info = records.MTG_INFO_REPLY.read(reply)
+
+    result = info.pop('result')
+    if result != 0:
+        raise DiscussError(result)
+
+    info['date_created'] = datetime.datetime.fromtimestamp(info['date_created'])
+    info['date_modified'] = datetime.datetime.fromtimestamp(info['date_modified'])
+    return info
+
+def _read_transaction_info(reply):
+    """Decodes the GET_TRN_INFO3 reply into a dictionary of header fields, as
+    they are on the wire."""
+
+    info = records.TRN_INFO_REPLY.read(reply)
+
+    result = info.pop('result')
+    if result != 0:
+        raise DiscussError(result)
+
+    return info
+
+def _make_transaction(meeting, info, cls):
+    """Creates the transaction object of the given class out of the header
+    fields."""
+
+    trn = cls(meeting, info['current'])
+    for name, value in info.items():
+        setattr(trn, name, value)
+    return trn
+
+def _read_transaction(meeting, reply, cls):
+    """Decodes the GET_TRN_INFO3 reply into a transaction object of the given
+    class."""
+
+    return _make_transaction(meeting, _read_transaction_info(reply), cls)
+
+def _make_post_request(name, text, subject, signature, reply_to):
+    """Builds the ADD_TRN (or ADD_TRN2) request and the TFILE block which has
+    to follow it."""
+
+    # The length is the one of the text as sent
+    if not isinstance(text, (bytes, bytearray)):
+        text = text.encode()
+
+    if signature:
+        request = USPBlock(constants.PROC_BASE + constants.ADD_TRN2)
+        records.ADD_TRN2_REQUEST.pack(request, name, len(text), subject, signature, reply_to)
+    else:
+        request = USPBlock(constants.PROC_BASE + constants.ADD_TRN)
+        records.ADD_TRN_REQUEST.pack(request, name, len(text), subject, reply_to)
+
+    # Yes, there is no two-byte padding involved.  I was actually
+    # surprised. It is quite possible that this is actually broken in some
+    # clever way.
+    tfile = USPBlock(constants.TFILE_BLK)
+    tfile.buffer = text
+
+    return request, tfile
+
+def _read_post_reply(reply):
+    """Decodes the ADD_TRN reply and returns the number of the new transaction."""
+
+    if reply.block_type != constants.REPLY_TYPE:
+        raise ProtocolError("Transport-level error")
+
+    new_id, result = records.ADD_TRN_REPLY.unpack(reply)
+    if result != 0:
+        raise DiscussError(result)
+
+    return new_id
+
+def _make_text_request(name, number):
+    """Builds the GET_TRN request for the text of the transaction."""
+
+    request = USPBlock(constants.PROC_BASE + constants.GET_TRN)
+    records.GET_TRN_REQUEST.pack(request, name, number, 0)
+    return request
+
+def _receive_text(rpc):
+    """Receives the response to GET_TRN and returns the text."""
+
+    tfile = rpc.receive()
+    if tfile.block_type == constants.REPLY_TYPE:
+        # The server may report an error without sending any text
+        return _read_text_reply(None, tfile)
+    reply = rpc.receive()
+    return _read_text_reply(tfile, reply)
+
+def _read_text_reply(tfile, reply):
+    """Decodes the TFILE block and the reply sent in response to GET_TRN.
+    The TFILE block is None if the server replied without sending one."""
+
+    _check_text_reply(reply)
+    if tfile is None or tfile.block_type != constants.TFILE_BLK:
+        raise ProtocolError("Bad server response when retriving transaction contents")
+
+    return tfile.buffer.decode()
+
+def _check_text_reply(reply):
+    if reply.block_type != constants.REPLY_TYPE:
+        raise ProtocolError("Bad server response when retriving transaction contents")
+    result, = records.RESULT.unpack(reply)
+    if result != 0:
+        raise DiscussError(result)
+
+def _iter_text(rpc, binary = False):
+    """Receives the response to GET_TRN and yields the text in pieces as the
+    subblocks of the TFILE block arrive. The pieces are decoded one by one
+    (a character split between two subblocks is carried over), or, if
+    binary is set, yielded as the raw bytes. If the iteration is stopped
+    early, the rest of the response is read out."""
+
+    subblocks = rpc.receive_subblocks()
+    block_type, payload, last = next(subblocks)
+
+    if block_type == constants.REPLY_TYPE:
+        # The server may report an error without sending any text
+        reply = USPBlock(block_type)
+        reply.buffer = bytearray(payload)
+        for block_type, payload, last in subblocks:
+            reply.buffer += payload
+        _check_text_reply(reply)
+        raise ProtocolError("Bad server response when retriving transaction contents")
+
+    text_type = block_type
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        while True:
+            if text_type == constants.TFILE_BLK:
+                chunk = payload.tobytes() if binary else decoder.decode(payload, last)
+                if chunk:
+                    # The rest of the text is still to be read
+                    rpc.busy = True
+                    try:
+                        yield chunk
+                    finally:
+                        rpc.busy = False
+            if last:
+                break
+            block_type, payload, last = next(subblocks)
+    except GeneratorExit:
+        for subblock in subblocks:
+            pass
+        rpc.receive()
+        raise
+
+    _check_text_reply(rpc.receive())
+    if text_type != constants.TFILE_BLK:
+        raise ProtocolError("Bad server response when retriving transaction contents")
+
+# Errors which mean that the transaction is gone, and which are skipped when
+# iterating over a range of transactions
+_SKIPPED_TRN_ERRORS = (constants.DELETED_TRN, constants.EXPUNGED_TRN)
+
 #
 # Here is a practcal description of discuss protocol:
 # 1. Connection is established.
@@ -43,10 +209,19 @@ def autoreconnects(f):
 class Client(object):
     """Discuss client."""
 
-    def __init__(self, server, port = 2100, auth = True, timeout = None, RPCClient=RPCClient):
-        self.rpc = RPCClient(server, port, auth, timeout)
-        if auth and self.who_am_i().startswith("???@"):
-            raise ProtocolError("Authentication to server failed")
+    def __init__(self, server, port = 2100, auth = True, timeout = None, RPCClient=RPCClient, pool = None):
+        self.pool = pool
+        if pool:
+            self.rpc = pool.acquire(server, port, auth, timeout)
+        else:
+            self.rpc = RPCClient(server, port, auth, timeout)
+
+        # Connections reused from the pool have already been checked
+        if auth and not getattr(self.rpc, 'authenticated', False):
+            if self.who_am_i().startswith("???@"):
+                self.close(reusable = False)
+                raise ProtocolError("Authentication to server failed")
+            self.rpc.authenticated = True
 
     @autoreconnects
     def get_server_version(self):
@@ -54,7 +229,8 @@ class Client(object):
 
         request = USPBlock(constants.GET_SERVER_VERSION)
         reply = self.rpc.request(request)
-        return reply.read_long_integer()
+        version, = records.SERVER_VERSION_REPLY.unpack(reply)
+        return version
 
     @autoreconnects
     def who_am_i(self):
@@ -63,28 +239,38 @@ class Client(object):
 
         request = USPBlock(constants.WHO_AM_I)
         reply = self.rpc.request(request)
-        return reply.read_string()
+        principal, = records.WHO_AM_I_REPLY.unpack(reply)
+        return principal
 
     @autoreconnects
     def create_mtg(self, location, long_mtg_name, public):
         request = USPBlock(constants.CREATE_MTG)
-        request.put_string(location)
-        request.put_string(long_mtg_name)
-        request.put_boolean(public)
+        records.CREATE_MTG_REQUEST.pack(request, location, long_mtg_name, public)
         reply = self.rpc.request(request)
-        result = reply.read_long_integer()
+        result, = records.RESULT.unpack(reply)
         if result != 0:
             raise DiscussError(result)
 
-    def close(self):
-        """Disconnect from the server."""
+    def close(self, reusable = True):
+        """Disconnect from the server. If the connection came from a pool, it
+        is returned there instead."""
 
-        self.rpc.socket.close()
+        if self.pool:
+            self.pool.release(self.rpc, reusable)
+        else:
+            self.rpc.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A connection may be in the middle of an exchange after an error
+        self.close(reusable = exc_type is None)
 
 class Meeting(object):
     """Discuss meeting."""
 
-    def __init__(self, client, name):
+    def __init__(self, client, name, store = None):
         self.client = client
         self.rpc = client.rpc
         self.name = name
@@ -92,6 +278,10 @@ class Meeting(object):
         self.id = (self.rpc.server, name)
         self.info_loaded = False
 
+        # Optional TransactionStore the headers and texts are read through
+        self.store = store
+        self.store_checked = False
+
     @autoreconnects
     def load_info(self, force = False):
         """Load all the properties into the class."""
@@ -100,24 +290,9 @@ class Meeting(object):
             return
 
         request = USPBlock(constants.GET_MTG_INFO)
-        request.put_string(self.name)
+        records.MTG_NAME.pack(request, self.name)
         reply = self.rpc.request(request)
-        self.version = reply.read_long_integer()
-        self.location = reply.read_string()
-        self.long_name = reply.read_string()
-        self.chairman = reply.read_string()
-        self.first = reply.read_long_integer()
-        self.last = reply.read_long_integer()
-        self.lowest = reply.read_long_integer()
-        self.highest = reply.read_long_integer()
-        self.date_created = datetime.datetime.fromtimestamp(reply.read_long_integer())
-        self.date_modified = datetime.datetime.fromtimestamp(reply.read_long_integer())
-        self.public = reply.read_boolean()
-        self.access_modes = reply.read_string()
-
-        result = reply.read_long_integer()
-        if result != 0:
-            raise DiscussError(result)
+        self.__dict__.update(_read_mtg_info(reply))
 
         self.info_loaded = True
 
@@ -128,13 +303,10 @@ class Meeting(object):
         if given is greater than real."""
 
         request = USPBlock(constants.UPDATED_MTG)
-        request.put_string(self.name)
-        request.put_long_integer(0) # This is the timestamp which server disregards
-        request.put_long_integer(last)
+        records.UPDATED_MTG_REQUEST.pack(request, self.name, 0, last)
         reply = self.rpc.request(request)
-        updated = reply.read_boolean()
+        updated, result = records.UPDATED_MTG_REPLY.unpack(reply)
 
-        result = reply.read_long_integer()
         if result != 0:
             raise DiscussError(result)
 
@@ -145,137 +317,505 @@ class Meeting(object):
         """Send request for the tranasction into the connection."""
 
         request = USPBlock(constants.GET_TRN_INFO3)
-        request.put_string(self.name)
-        request.put_long_integer(number)
+        records.TRN_NUMBER.pack(request, self.name, number)
 
         request.block_type += constants.PROC_BASE
-        self.rpc.send(request)
+        self.rpc.queue(request)
 
     @autoreconnects
     def receive_transaction(self):
         """Read the transaction from the connection."""
 
         reply = self.rpc.receive()
-
-        version = reply.read_long_integer()
-        number = reply.read_long_integer()
-
-        trn = Transaction(self, number)
-        trn.version = version
-        trn.current = number
-        trn.prev = reply.read_long_integer()
-        trn.next = reply.read_long_integer()
-        trn.pref = reply.read_long_integer()
-        trn.nref = reply.read_long_integer()
-        trn.fref = reply.read_long_integer()
-        trn.lref = reply.read_long_integer()
-        trn.chain_index = reply.read_long_integer()
-        trn.date_entered = datetime.datetime.fromtimestamp(reply.read_long_integer())
-        trn.num_lines = reply.read_long_integer()
-        trn.num_chars = reply.read_long_integer()
-        trn.subject = reply.read_string()
-        trn.author = reply.read_string()
-        trn.flags = reply.read_long_integer()
-        trn.signature = reply.read_string()
-
-        result = reply.read_long_integer()
-        if result != 0:
-            raise DiscussError(result)
-
-        return trn
+        return _read_transaction(self, reply, Transaction)
 
     @autoreconnects
     def get_transaction(self, number):
         """Retrieve the informataion about a transaction using the number."""
 
+        if self.store is not None:
+            self._check_store()
+            info = self.store.get_header(self.id, number)
+            if info is False:
+                raise DiscussError(constants.DELETED_TRN)
+            if info:
+                return _make_transaction(self, info, Transaction)
+
         self.request_transaction(number)
+        reply = self.rpc.receive()
+        try:
+            info = _read_transaction_info(reply)
+        except DiscussError as err:
+            if self.store is not None and err.code in _SKIPPED_TRN_ERRORS:
+                self.store.put_headers(self.id, [], [number])
+            raise err
 
-        return self.receive_transaction()
+        if self.store is not None:
+            self.store.put_headers(self.id, [info])
+        return _make_transaction(self, info, Transaction)
 
     @autoreconnects
     def transactions(self, start = 1, end = -1, feedback = None):
+        """Return the list of transactions in the given range. Without
+        arguments, returns all transactions. See iter_transactions() for
+        the streaming version."""
+
+        return list(self.iter_transactions(start, end, feedback))
+
+    def iter_transactions(self, start = 1, end = -1, feedback = None, abandon = False, window = None):
         """Return an iterator over the given range of transaction. Without
-        arguments, iterates over all transactions."""
+        arguments, iterates over all transactions.
+
+        Each transaction is yielded as soon as its header is decoded, while
+        the pipeline of requests is kept full, so only the replies in flight
+        are held in memory. If the iterator is closed early, the replies
+        which are still in flight are read out and discarded, so that the
+        connection can be used further; with abandon set, the connection is
+        reopened instead, which is faster when many replies are in flight.
+
+        The number of requests in flight adapts to the measured round trip
+        time and reply rate, unless window is given as a number. The window
+        and the measurements are available as pipeline_stats.
+
+        If the meeting has a store, only the headers which are not stored
+        are requested from the server.
+
+        While the iterator has requests in flight, the connection must not
+        be used for anything else: calling the server from the body of the
+        loop (e.g. trn.get_text()) raises ConnectionBusy. Use get_texts() to
+        fetch the texts along with the headers, collect the transactions
+        first, or use another connection."""
+
+        if self.store is not None:
+            self._check_store(force = True)
+        if end == -1:
+            self.load_info()
+            end = self.last
 
+        source = self._header_source(start, end, abandon, window)
+        try:
+            for info in source:
+                trn = _make_transaction(self, info, Transaction)
+                if feedback:
+                    feedback(cur = trn.number, total = end - start + 1, left = end - trn.number + 1)
+                yield trn
+        finally:
+            source.close()
+
+    def iter_headers(self, start = 1, end = -1, abandon = False, window = None):
+        """Like iter_transactions(), but yields the header fields of every
+        transaction as a dictionary, as they are on the wire (the number of
+        the transaction is in 'current'), without building the Transaction
+        objects."""
+
+        if self.store is not None:
+            self._check_store(force = True)
         if end == -1:
             self.load_info()
             end = self.last
 
-        to_request = end - start + 1
-        to_read = to_request
-        buffer_size = 500   # Amount of requests which may be sent at one instant
+        return self._header_source(start, end, abandon, window)
+
+    def _header_source(self, start, end, abandon = False, window = None):
+        if self.store is not None:
+            return self._iter_stored_headers(start, end, abandon, window)
+        return self._fetch_headers(range(start, end + 1), abandon, window)
+
+    def get_texts(self, start = 1, end = -1, feedback = None, abandon = False, window = None):
+        """Return an iterator over (transaction, text) pairs for the given
+        range of transactions. Without arguments, iterates over all
+        transactions.
+
+        Both the header and the text requests are pipelined over the
+        connection, with at most the window of requests outstanding (see
+        iter_transactions() for the meaning of window and abandon). The text
+        is only requested once the header has been received, so deleted and
+        expunged transactions are skipped without fetching anything else.
+
+        As with iter_transactions(), the connection must not be used from
+        the body of the loop."""
+
+        if self.store is not None:
+            self._check_store(force = True)
+        if end == -1:
+            self.load_info()
+            end = self.last
+
+        if self.store is not None:
+            for pair in self._get_stored_texts(start, end, feedback, abandon, window):
+                yield pair
+            return
+
+        flow = make_window(window, self.rpc.socket)
+        self.pipeline_stats = flow.stats
         cur = start
 
-        result = []
-        while to_read != 0:
-            if to_read - to_request <= buffer_size and to_request > 0:
-                # Send another request
-                self.request_transaction(cur)
-                cur += 1
-                to_request -= 1
-            else:
-                # Start reading things
+        # Requests in flight, in the order they were sent. Each item is a
+        # header request (None, number) or a text request (transaction, None).
+        pending = deque()
+
+        try:
+            while cur <= end or pending:
+                if cur <= end and len(pending) < flow.window:
+                    self.request_transaction(cur)
+                    flow.sent()
+                    pending.append((None, cur))
+                    cur += 1
+                    continue
+
+                trn, number = pending[0]
+                if trn is None:
+                    reply = self.rpc.receive()
+                    pending.popleft()
+                    flow.received(len(reply.buffer))
+                    try:
+                        trn = _read_transaction(self, reply, Transaction)
+                    except DiscussError as err:
+                        if err.code not in _SKIPPED_TRN_ERRORS:
+                            raise err
+                        continue
+
+                    self.rpc.queue(_make_text_request(self.name, trn.number))
+                    flow.sent()
+                    pending.append((trn, None))
+                else:
+                    try:
+                        text = _receive_text(self.rpc)
+                    except DiscussError as err:
+                        pending.popleft()
+                        flow.received(0)
+                        if err.code not in _SKIPPED_TRN_ERRORS:
+                            raise err
+                        continue
+                    pending.popleft()
+                    flow.received(len(text))
+
+                    if feedback:
+                        feedback(cur = trn.number, total = end - start + 1, left = end - trn.number + 1)
+                    self.rpc.busy = bool(pending)
+                    try:
+                        yield trn, text
+                    finally:
+                        self.rpc.busy = False
+        finally:
+            self._discard_in_flight(len(pending), abandon)
+
+    def _pipeline(self, items, request, receive, abandon = False, window = None):
+        """Sends a request for every item and yields (item, result) pairs in
+        the same order, keeping the window of requests in flight. The
+        request function queues the request for an item, and may return its
+        size in bytes; the receive function reads the reply and returns a
+        (result, size in bytes) pair."""
+
+        flow = make_window(window, self.rpc.socket)
+        self.pipeline_stats = flow.stats
+        items = iter(items)
+        exhausted = False
+        pending = deque()
+
+        try:
+            while True:
+                if not exhausted and len(pending) < flow.window:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                    flow.sent(request(item) or 0)
+                    pending.append(item)
+                    continue
+
+                if not pending:
+                    return
+
+                try:
+                    result, size = receive(pending[0])
+                except DiscussError:
+                    pending.popleft()
+                    flow.received(0)
+                    raise
+                item = pending.popleft()
+                flow.received(size)
+
+                # The replies to the other requests must not be taken by
+                # whatever the consumer does with the connection meanwhile
+                self.rpc.busy = bool(pending)
                 try:
-                    trn = self.receive_transaction()
-                    result.append(trn)
+                    yield item, result
+                finally:
+                    self.rpc.busy = False
+        finally:
+            self._discard_in_flight(len(pending), abandon)
+
+    def _receive_header(self, number):
+        """Reads the GET_TRN_INFO3 reply. Returns None instead of the header
+        fields for deleted and expunged transactions."""
+
+        reply = self.rpc.receive()
+        try:
+            return _read_transaction_info(reply), len(reply.buffer)
+        except DiscussError as err:
+            if err.code not in _SKIPPED_TRN_ERRORS:
+                raise err
+            return None, len(reply.buffer)
+
+    def _fetch_headers(self, numbers, abandon = False, window = None):
+        """Pipelined retrieval of the header fields of the transactions with
+        given numbers. Deleted and expunged transactions are skipped."""
+
+        for number, info in self._pipeline(numbers, self.request_transaction,
+                self._receive_header, abandon, window):
+            if info is not None:
+                yield info
+
+    def _fetch_headers_into_store(self, numbers, abandon = False, window = None):
+        """Retrieves the headers and puts them into the store, including the
+        information about the transactions which are gone."""
+
+        batch, deleted = [], []
+        for number, info in self._pipeline(numbers, self.request_transaction,
+                self._receive_header, abandon, window):
+            if info is None:
+                deleted.append(number)
+            else:
+                batch.append(info)
+            if len(batch) + len(deleted) >= 1000:
+                self.store.put_headers(self.id, batch, deleted)
+                batch, deleted = [], []
+
+        self.store.put_headers(self.id, batch, deleted)
+
+    def _check_store(self, force = False):
+        """Validates the store against the current meeting information and
+        drops whatever has become stale. Unless forced, this is done once per
+        meeting object."""
+
+        if self.store_checked and not force:
+            return
+
+        self.load_info(force = True)
+        date_modified = self.date_modified.isoformat()
+        current = (self.last, self.highest, date_modified)
+        state = self.store.get_state(self.id)
+
+        if state is None or self.highest < state[1]:
+            # Never seen or recreated
+            self.store.invalidate(self.id)
+        elif state != current:
+            if not (self.highest > state[1] and self._refresh_grown_store(state[0], state[1])):
+                # Something else than new transactions: any header might
+                # have changed
+                self.store.invalidate_headers(self.id)
+
+        self.store.set_state(self.id, *current)
+        self.store_checked = True
+
+    def _refresh_grown_store(self, old_last, old_highest):
+        """Fetches the headers of the transactions added after old_highest,
+        and again the headers of the old ones they changed: the previous
+        last transaction, and the first and the last transactions of the
+        chains the new ones were appended to; the other stored members of
+        those chains get their new last transaction. Returns False if the
+        meeting was modified otherwise as well, that is, if its modification
+        date is not the date of its newest transaction."""
+
+        self._fetch_headers_into_store(range(old_highest + 1, self.highest + 1))
+
+        changed = set([old_last]) if old_last else set()
+        chains = {}         # First transaction -> the last one before the new ones
+        newest = None
+        for info in self.store.headers(self.id, old_highest + 1, self.highest):
+            first, previous = info['fref'], info['pref']
+            if 0 < first <= old_highest:
+                changed.add(first)
+                if 0 < previous <= old_highest:
+                    changed.add(previous)
+                    chains.setdefault(first, previous)
+            newest = info
+
+        if newest is None or newest['current'] != self.last or \
+                datetime.datetime.fromtimestamp(newest['date_entered']) != self.date_modified:
+            return False
+
+        self._fetch_headers_into_store(sorted(changed))
+        for first, old_end in chains.items():
+            head = self.store.get_header(self.id, first)
+            if head:
+                self.store.extend_chain(self.id, first, old_end, head['lref'])
+        return True
+
+    def _iter_stored_headers(self, start, end, abandon = False, window = None, batch = 1000):
+        """Brings the stored headers in the range up to date and iterates
+        over them. The range is processed batch transactions at a time, so
+        the memory use does not depend on its size."""
+
+        for first in range(start, end + 1, batch):
+            last = min(first + batch - 1, end)
+            missing = self.store.missing_headers(self.id, first, last)
+            if missing:
+                self._fetch_headers_into_store(missing, abandon, window)
+
+            for info in self.store.headers(self.id, first, last):
+                yield info
+
+    def _receive_text_for(self, trn):
+        try:
+            text = _receive_text(self.rpc)
+        except DiscussError as err:
+            if err.code not in _SKIPPED_TRN_ERRORS:
+                raise err
+            return None, 0
+        return text, len(text)
+
+    def _request_text_for(self, trn):
+        self.rpc.queue(_make_text_request(self.name, trn.number))
+
+    def _get_stored_texts(self, start, end, feedback, abandon, window):
+        """Implementation of get_texts() for meetings with a store."""
+
+        batch_size = 1000
+        stored = self._iter_stored_headers(start, end, abandon, window)
+        headers = (_make_transaction(self, info, Transaction) for info in stored)
+        try:
+            while True:
+                batch = list(itertools.islice(headers, batch_size))
+                if not batch:
+                    return
+
+                missing = set(self.store.missing_texts(self.id, (trn.number for trn in batch)))
+                fetched = {}
+                if missing:
+                    to_fetch = [trn for trn in batch if trn.number in missing]
+                    gone = []
+                    for trn, text in self._pipeline(to_fetch, self._request_text_for,
+                            self._receive_text_for, abandon, window):
+                        if text is not None:
+                            fetched[trn.number] = text
+                        else:
+                            gone.append(trn.number)
+                    self.store.put_texts(self.id, fetched.items())
+                    # The stored header was stale (see _check_store())
+                    self.store.put_headers(self.id, [], gone)
+
+                for trn in batch:
+                    if trn.number in fetched:
+                        text = fetched[trn.number]
+                    elif trn.number in missing:
+                        continue
+                    else:
+                        text = self.store.get_text(self.id, trn.number)
+
                     if feedback:
-                        feedback(cur = trn.number, total = end - start + 1, left = to_read)
-                except DiscussError as err:
-                    if err.code != constants.DELETED_TRN:
-                        raise err
-                to_read -= 1
+                        feedback(cur = trn.number, total = end - start + 1, left = end - trn.number + 1)
+                    yield trn, text
+        finally:
+            stored.close()
+
+    def _discard_in_flight(self, count, abandon = False):
+        """Get rid of the replies to the requests which have been sent but
+        will not be read, by reading them or by reconnecting. TFILE blocks
+        which precede the replies to GET_TRN are skipped."""
+
+        if count <= 0:
+            return
+
+        # Nothing to clean up if the owner has closed the connection
+        sock = self.rpc.socket
+        if hasattr(sock, 'fileno') and sock.fileno() == -1:
+            return
 
-        return result
+        if not abandon:
+            try:
+                while count > 0:
+                    block = self.rpc.receive()
+                    if block.block_type == constants.REPLY_TYPE:
+                        count -= 1
+                return
+            except (socket.error, ProtocolError):
+                pass
+
+        self.rpc.socket.close()
+        self.rpc.connect()
 
     @autoreconnects
     def post(self, text, subject, signature = None, reply_to = 0):
         """Add a transaction to the meeting."""
 
-        request = USPBlock(constants.PROC_BASE + (constants.ADD_TRN2 if signature else constants.ADD_TRN))
-        request.put_string(self.name)
-        request.put_long_integer(len(text))
-        request.put_string(subject)
-        if signature:
-            request.put_string(signature)
-        request.put_long_integer(reply_to)
-
-        # Yes, there is no two-byte padding involved.  I was actually
-        # surprised. It is quite possible that this is actually broken in some
-        # clever way.
-        tfile = USPBlock(constants.TFILE_BLK)
-        tfile.buffer = text
-
-        self.rpc.send(request)
-        self.rpc.send(tfile)
+        request, tfile = _make_post_request(self.name, text, subject, signature, reply_to)
+
+        self.rpc.queue(request)
+        self.rpc.queue(tfile)
         reply = self.rpc.receive()
-        if reply.block_type != constants.REPLY_TYPE:
-            raise ProtocolError("Transport-level error")
-        
-        new_id = reply.read_long_integer()
-        result = reply.read_long_integer()
-        if result != 0:
-            raise DiscussError(result)
+        new_id = _read_post_reply(reply)
 
         return self.get_transaction(new_id)
 
+    def post_many(self, posts, headers = False, feedback = None, abandon = False, window = None):
+        """Add many transactions to the meeting, with the requests pipelined
+        (see iter_transactions() for window and abandon; by default, the
+        window adapts up to 256 posts in flight). Every post is a tuple of
+        the arguments of post(): (text, subject[, signature[, reply_to]]).
+
+        Returns the list of results in the order of the posts: the number of
+        the new transaction, or the DiscussError if that post failed, which
+        does not stop the other posts. With headers set, the headers of the
+        new transactions are fetched, also pipelined, once all the posts are
+        done, and the numbers are replaced by the Transaction objects."""
+
+        if window is None:
+            window = AdaptiveWindow(maximum = 256)
+        total = len(posts) if hasattr(posts, '__len__') else None
+
+        def request(post):
+            text, subject, signature, reply_to = tuple(post) + (None, 0)[len(post) - 2:]
+            request, tfile = _make_post_request(self.name, text, subject, signature, reply_to)
+            return self.rpc.queue(request) + self.rpc.queue(tfile)
+
+        def receive(post):
+            reply = self.rpc.receive()
+            try:
+                return _read_post_reply(reply), len(reply.buffer)
+            except DiscussError as err:
+                return err, len(reply.buffer)
+
+        results = []
+        for post, result in self._pipeline(posts, request, receive, abandon, window):
+            results.append(result)
+            if feedback:
+                feedback(cur = len(results), total = total,
+                        left = total - len(results) if total is not None else None)
+
+        if headers:
+            numbers = [result for result in results if not isinstance(result, DiscussError)]
+            transactions = dict( (trn.number, trn) for trn in self.get_transactions(numbers) )
+            results = [transactions.get(result, result) if not isinstance(result, DiscussError)
+                    else result for result in results]
+
+        return results
+
+    def get_transactions(self, numbers, abandon = False, window = None):
+        """Retrieve the transactions with the given numbers, with the requests
+        pipelined. Deleted and expunged transactions are left out."""
+
+        return [ _make_transaction(self, info, Transaction)
+                for info in self._fetch_headers(numbers, abandon, window) ]
+
     @autoreconnects
     def get_acl(self):
         """Retrieve the access list of the meeting. Returns the list
         of principal-access tuples."""
 
         request = USPBlock(constants.GET_ACL)
-        request.put_string(self.name)
+        records.MTG_NAME.pack(request, self.name)
         reply = self.rpc.request(request)
 
-        result = reply.read_long_integer()
+        result, length = records.ACL_REPLY.unpack(reply)
         if result != 0:
             raise DiscussError(result)
 
-        length = reply.read_long_integer()
         acl = []
         for i in range(length):
-            modes = reply.read_string()
-            principal = reply.read_string()
+            modes, principal = records.ACL_ENTRY.unpack(reply)
             # Note: this level of abstraction is probably thinner then I'd like
             acl.append( (principal, modes) )
 
@@ -286,12 +826,10 @@ class Meeting(object):
         """Retrieve the access mode of a given Kerberos principal."""
 
         request = USPBlock(constants.GET_ACCESS)
-        request.put_string(self.name)
-        request.put_string(principal)
+        records.GET_ACCESS_REQUEST.pack(request, self.name, principal)
         reply = self.rpc.request(request)
 
-        modes = reply.read_string()
-        result = reply.read_long_integer()
+        modes, result = records.GET_ACCESS_REPLY.unpack(reply)
         if result != 0:
             raise DiscussError(result)
 
@@ -302,12 +840,10 @@ class Meeting(object):
         """Changes the access mode of the given principal."""
 
         request = USPBlock(constants.SET_ACCESS)
-        request.put_string(self.name)
-        request.put_string(principal)
-        request.put_string(modes)
+        records.SET_ACCESS_REQUEST.pack(request, self.name, principal, modes)
         reply = self.rpc.request(request)
 
-        result = reply.read_long_integer()
+        result, = records.RESULT.unpack(reply)
         if result != 0:
             raise DiscussError(result)
 
@@ -325,11 +861,10 @@ class Meeting(object):
         """Undelete the transaction by its number."""
 
         request = USPBlock(constants.RETRIEVE_TRN)
-        request.put_string(self.name)
-        request.put_long_integer(trn_number)
+        records.TRN_NUMBER.pack(request, self.name, trn_number)
         reply = self.rpc.request(request)
 
-        result = reply.read_long_integer()
+        result, = records.RESULT.unpack(reply)
         if result != 0:
             raise DiscussError(result)
 
@@ -337,41 +872,90 @@ class Meeting(object):
 class Transaction(object):
     """Discuss transaction. Returned by methods of the meeting object."""
 
+    # Meetings may have hundreds of thousands of transactions, so the header
+    # fields are kept in slots instead of a dictionary
+    __slots__ = ('meeting', 'number', '_date_entered') + tuple(name
+            for name in records.TRN_INFO_REPLY.names if name not in ('date_entered', 'result'))
+
     def __init__(self, meeting, number):
         self.meeting = meeting
         self.number = number
-        self.rpc = meeting.rpc
+
+    @property
+    def rpc(self):
+        return self.meeting.rpc
+
+    @property
+    def date_entered(self):
+        """Time the transaction was entered. It comes as a timestamp and is
+        converted into datetime on the first access."""
+
+        date = self._date_entered
+        if not isinstance(date, datetime.datetime):
+            date = self._date_entered = datetime.datetime.fromtimestamp(date)
+        return date
+
+    @date_entered.setter
+    def date_entered(self, value):
+        self._date_entered = value
 
     @autoreconnects
     def get_text(self):
         """Retrieve the text of the transaction."""
 
-        request = USPBlock(constants.PROC_BASE + constants.GET_TRN)
-        request.put_string(self.meeting.name)
-        request.put_long_integer(self.number)
-        request.put_long_integer(0)
-        self.rpc.send(request)
-
-        tfile = self.rpc.receive()
-        reply = self.rpc.receive()
-        if tfile.block_type != constants.TFILE_BLK or reply.block_type != constants.REPLY_TYPE:
-            raise ProtocolError("Bad server response when retriving transaction contents")
-        result = reply.read_long_integer()
-        if result != 0:
-            raise DiscussError(result)
-
-        return tfile.buffer.decode()
+        store = self.meeting.store
+        if store is not None:
+            text = store.get_text(self.meeting.id, self.number)
+            if text is not None:
+                return text
+
+        self.rpc.queue(_make_text_request(self.meeting.name, self.number))
+        text = _receive_text(self.rpc)
+
+        if store is not None:
+            store.put_texts(self.meeting.id, [(self.number, text)])
+        return text
+
+    def iter_text(self, binary = False):
+        """Iterate over the text of the transaction in pieces, as they arrive
+        from the server, without ever holding the whole text. With binary
+        set, the pieces are the UTF-8 bytes as sent by the server. The text
+        is not added to the store of the meeting. The connection must not be
+        used until the iteration is over."""
+
+        store = self.meeting.store
+        if store is not None:
+            text = store.get_text(self.meeting.id, self.number)
+            if text is not None:
+                yield text.encode() if binary else text
+                return
+
+        self.rpc.queue(_make_text_request(self.meeting.name, self.number))
+        for chunk in _iter_text(self.rpc, binary):
+            yield chunk
+
+    def write_text(self, target):
+        """Write the text of the transaction into the file object as it
+        arrives (see iter_text()). Binary files get the bytes as sent by the
+        server, text files get the decoded text. Returns the amount of data
+        written, in bytes or characters respectively."""
+
+        binary = isinstance(target, (io.RawIOBase, io.BufferedIOBase))
+        written = 0
+        for chunk in self.iter_text(binary):
+            target.write(chunk)
+            written += len(chunk)
+        return written
 
     @autoreconnects
     def delete(self):
         """Delete the transaction."""
 
         request = USPBlock(constants.DELETE_TRN)
-        request.put_string(self.meeting.name)
-        request.put_long_integer(self.number)
+        records.TRN_NUMBER.pack(request, self.meeting.name, self.number)
         reply = self.rpc.request(request)
 
-        result = reply.read_long_integer()
+        result, = records.RESULT.unpack(reply)
         if result != 0:
             raise DiscussError(result)
 
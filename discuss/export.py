@@ -0,0 +1,220 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the export of meetings into mail folders,
+# either a single mbox file or a Maildir. The transactions are streamed from
+# the server together with their texts (see Meeting.get_texts()) and written
+# out one by one, so the memory use does not depend on the size of the
+# meeting.
+#
+# The exporter remembers the last transaction written for every meeting in a
+# small state file next to the folder (".discuss-export" inside a Maildir,
+# or the name of the mbox with ".discuss-export" appended), so an export which
+# was interrupted continues where it stopped, and running it again later only
+# adds the new transactions. For an mbox, the state also records the size of
+# the file, and anything written after it is cut off on resume, so a message
+# which was half-written when the export was interrupted does not remain.
+#
+# Example:
+#
+#     MboxExporter("vasilvv-test.mbox").export(mtg)
+#
+
+from email.header import Header
+from email.utils import formataddr, formatdate
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+
+_FROM_LINE = re.compile(r"^(>*From )", re.MULTILINE)
+
+def _message_id(mtg_id, number):
+    host, path = mtg_id
+    return "<%i.%s@%s>" % (number, path.strip('/').replace('/', '.'), host)
+
+def _header(value):
+    """Encodes the header value if it is not plain ASCII."""
+
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode()
+
+def format_message(meeting, trn, text):
+    """Returns the transaction as an RFC 2822 message, as a string. The chain
+    of the transaction is represented by In-Reply-To and References headers,
+    and by the X-Discuss-* headers, which carry all the chain pointers."""
+
+    timestamp = time.mktime(trn.date_entered.timetuple())
+    lines = [
+        "From: %s" % _header(formataddr((trn.signature, trn.author)) if trn.signature else trn.author),
+        "Date: %s" % formatdate(timestamp, localtime = True),
+        "Subject: %s" % _header(trn.subject),
+        "Message-ID: %s" % _message_id(meeting.id, trn.number),
+    ]
+    if trn.pref:
+        lines.append("In-Reply-To: %s" % _message_id(meeting.id, trn.pref))
+        references = [trn.pref]
+        if trn.fref and trn.fref not in (trn.pref, trn.number):
+            references.insert(0, trn.fref)
+        lines.append("References: %s" % " ".join(_message_id(meeting.id, number) for number in references))
+    lines += [
+        "X-Discuss-Meeting: %s:%s" % meeting.id,
+        "X-Discuss-Transaction: %i" % trn.number,
+        "X-Discuss-Chain: pref=%i nref=%i fref=%i lref=%i" % (trn.pref, trn.nref, trn.fref, trn.lref),
+        "MIME-Version: 1.0",
+        "Content-Type: text/plain; charset=utf-8",
+        "Content-Transfer-Encoding: 8bit",
+    ]
+
+    if not text.endswith("\n"):
+        text += "\n"
+    return "\n".join(lines) + "\n\n" + text
+
+class Exporter(object):
+    """Base class of the exporters. Subclasses implement open(), write() and
+    close(), and set state_location."""
+
+    def load_state(self):
+        try:
+            with open(self.state_location, "r") as source:
+                return json.load(source)
+        except (IOError, ValueError):
+            return { 'meetings' : {} }
+
+    def save_state(self, state):
+        directory = os.path.dirname(os.path.abspath(self.state_location))
+        fd, temp_path = tempfile.mkstemp(dir = directory, prefix = ".discuss-export")
+        try:
+            with os.fdopen(fd, "w") as target:
+                json.dump(state, target)
+            os.rename(temp_path, self.state_location)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def last_exported(self, mtg_id):
+        """Returns the number of the last transaction of the meeting which has
+        been exported, or 0."""
+
+        return self.load_state()['meetings'].get("%s:%s" % mtg_id, 0)
+
+    def export(self, meeting, end = -1, checkpoint = 100, feedback = None, window = None):
+        """Write the transactions of the meeting after the last exported one
+        (up to end, or all of them) into the folder. The state is saved after
+        every checkpoint messages and at the end. Returns the number of
+        messages written."""
+
+        state = self.load_state()
+        key = "%s:%s" % meeting.id
+        start = state['meetings'].get(key, 0) + 1
+        if end == -1:
+            meeting.load_info(force = True)
+            end = meeting.last
+        if start > end:
+            return 0
+
+        self.open(state)
+        count = 0
+        source = meeting.get_texts(start, end, feedback = feedback, window = window)
+        try:
+            for trn, text in source:
+                self.write(meeting, trn, text)
+                count += 1
+                if count % checkpoint == 0:
+                    self._checkpoint(state, key, trn.number)
+
+            # Deleted transactions at the end are skipped, but they are done
+            self._checkpoint(state, key, end)
+        finally:
+            source.close()
+            self.close()
+
+        return count
+
+    def _checkpoint(self, state, key, last):
+        # If the export fails, the state stays at the previous checkpoint, and
+        # the messages after it are written again on the next run
+        state['meetings'][key] = last
+        self.sync(state)
+        self.save_state(state)
+
+    def sync(self, state):
+        pass
+
+class MboxExporter(Exporter):
+    """Appends the transactions to an mbox file (in the mboxrd format, where
+    every line of the body which starts with "From ", possibly after some
+    ">" characters, gets another ">" in front of it)."""
+
+    def __init__(self, location):
+        self.location = location
+        self.state_location = location + ".discuss-export"
+        self.target = None
+
+    def open(self, state):
+        self.target = open(self.location, "ab")
+        # Drop whatever was written after the last checkpoint
+        size = state.get('size')
+        if size is not None and size < self.target.tell():
+            self.target.truncate(size)
+            self.target.seek(size)
+
+        # Record where this run starts, so that a run interrupted before its
+        # first checkpoint is cut off as well
+        state['size'] = self.target.tell()
+        self.save_state(state)
+
+    def write(self, meeting, trn, text):
+        date = time.asctime(trn.date_entered.timetuple())
+        message = format_message(meeting, trn, text)
+        headers, body = message.split("\n\n", 1)
+        data = "From %s %s\n%s\n\n%s\n" % (trn.author or "MAILER-DAEMON", date,
+                headers, _FROM_LINE.sub(r">\1", body))
+        self.target.write(data.encode('utf-8'))
+
+    def sync(self, state):
+        if self.target is not None:
+            self.target.flush()
+            os.fsync(self.target.fileno())
+            state['size'] = self.target.tell()
+
+    def close(self):
+        if self.target is not None:
+            self.target.close()
+            self.target = None
+
+class MaildirExporter(Exporter):
+    """Writes every transaction into a separate file of a Maildir. The file
+    names are derived from the meeting and the transaction number, so a
+    transaction exported again replaces the old copy."""
+
+    def __init__(self, location):
+        self.location = location
+        self.state_location = os.path.join(location, ".discuss-export")
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+
+    def open(self, state):
+        for subdirectory in ("tmp", "new", "cur"):
+            path = os.path.join(self.location, subdirectory)
+            if not os.path.isdir(path):
+                os.makedirs(path, 0o700)
+
+    def write(self, meeting, trn, text):
+        host, path = meeting.id
+        name = "%i.discuss_%s_%s_%i.%s" % (time.mktime(trn.date_entered.timetuple()),
+                host, path.strip('/').replace('/', '.'), trn.number, self.hostname)
+
+        # Maildir delivery: write into tmp/, then move into new/
+        temp_path = os.path.join(self.location, "tmp", name)
+        with open(temp_path, "wb") as target:
+            target.write(format_message(meeting, trn, text).encode('utf-8'))
+        os.rename(temp_path, os.path.join(self.location, "new", name))
+
+    def close(self):
+        pass
@@ -10,14 +10,40 @@
 #
 
 from .client import Client, Meeting, DiscussError
-from .constants import NO_SUCH_MTG
+from .constants import NO_SUCH_MTG, MTG_MOVED
+from .rcfile import locate_cache_file, _make_parent_directory
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import errno
+import fcntl
+import json
 import os
 import re
+import socket
+import tempfile
+import threading
+import time
+
+# Parsed server lists, keyed by file name: (mtime, size, servers)
+_server_list_cache = {}
 
 def _read_server_list(filename):
-    """Parses the given list of discuss servers."""
+    """Parses the given list of discuss servers. The result is cached until
+    the file's modification time changes."""
+
+    try:
+        stat = os.stat(filename)
+    except OSError as err:
+        # File is allowed not to exist
+        if err.errno == errno.ENOENT:
+            _server_list_cache.pop(filename, None)
+            return []
+        else:
+            raise err
+
+    cached = _server_list_cache.get(filename)
+    if cached and cached[0:2] == (stat.st_mtime, stat.st_size):
+        return list(cached[2])
 
     try:
         source = open(filename, "r")
@@ -30,7 +56,8 @@ def _read_server_list(filename):
         lines = map(str.strip, lines)          # whitespace
         lines = [x for x in lines if x]     # empty lines
 
-        return lines
+        _server_list_cache[filename] = (stat.st_mtime, stat.st_size, lines)
+        return list(lines)
     except IOError as err:
         # File is allowed not to exist
         if err.errno == errno.ENOENT:
@@ -48,27 +75,242 @@ def get_servers():
     return global_servers + [ server
             for server in user_servers if server not in global_servers ]
 
-def locate(name):
+def measure_latency(server, port = 2100, timeout = 5):
+    """Returns the time it takes to open a TCP connection to the server, or
+    None if it is unreachable."""
+
+    start = time.time()
+    try:
+        sock = socket.create_connection((server, port), timeout)
+    except (socket.error, socket.timeout):
+        return None
+    elapsed = time.time() - start
+    sock.close()
+    return elapsed
+
+def order_by_latency(servers, port = 2100, timeout = 5):
+    """Sorts the servers by the measured connection latency, keeping the
+    original order for servers with the same latency. Unreachable servers
+    go last."""
+
+    if not servers:
+        return []
+
+    with ThreadPoolExecutor(max_workers = len(servers)) as executor:
+        latencies = list(executor.map(partial(measure_latency, port = port, timeout = timeout), servers))
+
+    unreachable = float("inf")
+    order = sorted(range(len(servers)),
+            key = lambda i: latencies[i] if latencies[i] is not None else unreachable)
+    return [servers[i] for i in order]
+
+def _probe(server, prefix, name, pool):
+    """Checks whether the meeting exists on the given server. Returns the
+    meeting with a live connection, or None if there is no such meeting."""
+
+    client = Client(server, pool = pool)
+    mtg = Meeting(client, prefix + name)
+    try:
+        mtg.load_info()
+        return mtg
+    except DiscussError as err:
+        client.close()
+        if err.code == NO_SUCH_MTG:
+            return None
+        raise err
+    except:
+        client.close(reusable = False)
+        raise
+
+def _close_probe(future):
+    """Closes the connection of a probe which lost the race."""
+
+    try:
+        mtg = future.result()
+    except Exception:
+        return
+    if mtg is not None:
+        mtg.client.close()
+
+class LocationCache(object):
+    """On-disk cache of meeting locations found by locate(). Maps meeting
+    names to (host, path) tuples; names which were not found anywhere are
+    remembered as well, for a shorter time."""
+
+    def __init__(self, location = None, ttl = 7 * 24 * 3600, negative_ttl = 3600):
+        self.location = location or locate_cache_file("locations.json")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = None
+        self.changes = {}       # Name -> entry, or None if removed, since the last save
+
+    def read(self):
+        """Returns the entries in the cache file. A missing or corrupted file
+        is an empty cache."""
+
+        try:
+            with open(self.location, "r") as source:
+                entries = json.load(source)
+            if not isinstance(entries, dict):
+                entries = {}
+        except (IOError, OSError, ValueError):
+            entries = {}
+        return entries
+
+    def load(self):
+        self.entries = self.read()
+        self.changes = {}
+
+    def save(self):
+        """Atomically replace the cache file with its current contents plus
+        the changes made by this object. The file is read again right before
+        it is replaced, under a lock file, so that the processes which share
+        the cache do not drop the entries of each other."""
+
+        directory = os.path.dirname(self.location)
+        _make_parent_directory(self.location)
+
+        with open(self.location + ".lock", "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            entries = self.read()
+            for name, entry in self.changes.items():
+                if entry is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = entry
+
+            fd, temp_path = tempfile.mkstemp(dir = directory or ".", prefix = ".locations")
+            try:
+                with os.fdopen(fd, "w") as target:
+                    json.dump(entries, target)
+                os.rename(temp_path, self.location)
+            except:
+                os.unlink(temp_path)
+                raise
+
+        self.entries = entries
+        self.changes = {}
+
+    def _ensure_loaded(self):
+        if self.entries is None:
+            self.load()
+
+    def get(self, name):
+        """Returns (found, location), where found is False if nothing is
+        known about the name, and location is either a (host, path) tuple or
+        None if the meeting is known not to exist."""
+
+        with self.lock:
+            self._ensure_loaded()
+            entry = self.entries.get(name)
+            if entry is None:
+                return False, None
+
+            location = tuple(entry["location"]) if entry["location"] else None
+            ttl = self.ttl if location else self.negative_ttl
+            if time.time() - entry["time"] > ttl:
+                return False, None
+            return True, location
+
+    def put(self, name, location):
+        """Remember the location of the meeting; None means there is no such
+        meeting."""
+
+        with self.lock:
+            self._ensure_loaded()
+            self.entries[name] = self.changes[name] = {
+                "location" : list(location) if location else None,
+                "time" : time.time(),
+            }
+            self.save()
+
+    def invalidate(self, name):
+        """Forget the location of the meeting."""
+
+        with self.lock:
+            self._ensure_loaded()
+            if self.entries.pop(name, None) is not None:
+                self.changes[name] = None
+                self.save()
+
+def lookup_location(name, cache, pool = None):
+    """Returns the (host, path) tuple of the meeting, or None if it does not
+    exist. Cached results are returned without touching the network;
+    otherwise the meeting is located and the result is cached."""
+
+    found, location = cache.get(name)
+    if found:
+        return location
+
+    mtg = locate(name, pool = pool, cache = cache)
+    if mtg is None:
+        return None
+    mtg.client.close()
+    return mtg.id
+
+def locate(name, pool = None, by_latency = False, cache = None):
     """Attempts to locate the meeting by looking for it on known
     discuss servers. If found, returns the meeting object with a live
-    connection."""
+    connection. If a connection pool is given, the connections are
+    borrowed from it.
 
-    servers = get_servers()
-    for server in servers:
-        client = Client(server)
-        for prefix in ("/var/spool/discuss/", "/usr/spool/discuss/"):
-            mtg_path = prefix + name
-            mtg = Meeting(client, mtg_path)
+    All the servers and spool prefixes are probed concurrently. The result
+    follows the order of the servers files (or the measured latency if
+    by_latency is set): a meeting found on a server is only returned once
+    every server before it has reported not having it.
+
+    If a LocationCache is given, the cached location is tried first. It is
+    dropped if the server replies that the meeting does not exist there or
+    has moved, in which case the servers are probed again."""
+
+    if cache is not None:
+        found, location = cache.get(name)
+        if found and location is None:
+            return None
+        if found:
+            client = Client(location[0], pool = pool)
+            mtg = Meeting(client, location[1])
             try:
                 mtg.load_info()
                 return mtg
             except DiscussError as err:
-                if err.code == NO_SUCH_MTG:
-                    continue
-                else:
-                    client.close()
+                client.close()
+                if err.code not in (NO_SUCH_MTG, MTG_MOVED):
                     raise err
+                cache.invalidate(name)
 
-        client.close()
+    mtg = _locate(name, pool, by_latency)
+    if cache is not None:
+        cache.put(name, mtg.id if mtg else None)
+    return mtg
+
+def _locate(name, pool, by_latency):
+    servers = get_servers()
+    if by_latency:
+        servers = order_by_latency(servers)
+
+    candidates = [ (server, prefix)
+            for server in servers
+            for prefix in ("/var/spool/discuss/", "/usr/spool/discuss/") ]
+    if not candidates:
+        return None
+
+    executor = ThreadPoolExecutor(max_workers = len(candidates))
+    futures = [ executor.submit(_probe, server, prefix, name, pool)
+            for server, prefix in candidates ]
+
+    try:
+        for i, future in enumerate(futures):
+            mtg = future.result()
+            if mtg is not None:
+                return mtg
+    finally:
+        # Everything after the winner (or after the error) is not needed
+        for future in futures[i + 1:]:
+            if not future.cancel():
+                future.add_done_callback(_close_probe)
+        executor.shutdown(wait = False)
 
     return None
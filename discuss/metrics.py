@@ -0,0 +1,186 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the collection of client metrics: how many
+# requests of every procedure were made and how long their replies took, how
+# much data went over the wire, how deep the pipeline was and how often the
+# connections had to be reopened.
+#
+# The connections report to the Metrics object in their metrics attribute,
+# which is None by default, so nothing is recorded unless it is asked for.
+# Recording is a few counter updates per block, cheap enough to keep enabled
+# in production.
+#
+# Example:
+#
+#     metrics = Metrics()
+#     RPCClient.metrics = metrics         # all connections
+#     ...
+#     print(metrics.snapshot()['calls'])
+#     open("/var/lib/node_exporter/discuss.prom", "w").write(metrics.prometheus())
+#
+
+from bisect import bisect_left
+import threading
+
+from . import constants
+
+# Procedure number -> name, as in rpc.h
+PROCEDURE_NAMES = dict( (getattr(constants, name), name) for name in (
+    "ADD_TRN", "GET_TRN_INFO", "DELETE_TRN", "RETRIEVE_TRN", "CREATE_MTG",
+    "OLD_GET_MTG_INFO", "START_MTG_INFO", "NEXT_MTG_INFO", "GET_TRN",
+    "REMOVE_MTG", "UPDATED_MTG", "GET_MTG_INFO", "GET_ACL", "GET_ACCESS",
+    "SET_ACCESS", "DELETE_ACCESS", "WHO_AM_I", "GET_TRN_INFO2",
+    "GET_SERVER_VERSION", "SET_TRN_FLAGS", "ADD_TRN2", "GET_TRN_INFO3") )
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the pipeline depth buckets, in requests
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # The last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Returns the histogram as a dictionary, with the bucket counts
+        cumulative, as Prometheus has them."""
+
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return { 'buckets' : list(zip(self.buckets + (float('inf'),), cumulative)),
+                 'count' : self.count, 'sum' : self.sum }
+
+class Metrics(object):
+    """Counters and histograms of the RPC traffic of the connections which
+    report to it. Safe to share between threads."""
+
+    def __init__(self, latency_buckets = LATENCY_BUCKETS, depth_buckets = DEPTH_BUCKETS):
+        self.lock = threading.Lock()
+        self.latency_buckets = latency_buckets
+        self.calls = {}                 # Procedure -> number of requests
+        self.latency = {}               # Procedure -> Histogram of reply times
+        self.depth = Histogram(depth_buckets)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.subblocks_sent = 0
+        self.subblocks_received = 0
+        self.blocks_sent = 0
+        self.blocks_received = 0
+        self.reconnects = 0
+        self.timeouts = 0
+
+    def block_sent(self, size, subblocks, procedure = None, depth = 0):
+        """Record a block sent. For requests, the procedure is given, together
+        with the number of requests in flight on the connection including
+        this one."""
+
+        with self.lock:
+            self.blocks_sent += 1
+            self.bytes_sent += size
+            self.subblocks_sent += subblocks
+            if procedure is not None:
+                self.calls[procedure] = self.calls.get(procedure, 0) + 1
+                self.depth.observe(depth)
+
+    def block_received(self, size, subblocks, procedure = None, latency = None):
+        """Record a block received. For replies, the procedure of the request
+        and the time it took are given."""
+
+        with self.lock:
+            self.blocks_received += 1
+            self.bytes_received += size
+            self.subblocks_received += subblocks
+            if procedure is not None:
+                histogram = self.latency.get(procedure)
+                if histogram is None:
+                    histogram = self.latency[procedure] = Histogram(self.latency_buckets)
+                histogram.observe(latency)
+
+    def reconnected(self):
+        with self.lock:
+            self.reconnects += 1
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        """Returns a consistent copy of all the metrics as a dictionary.
+        Procedures are referred to by their names."""
+
+        name = lambda procedure: PROCEDURE_NAMES.get(procedure, str(procedure))
+        with self.lock:
+            return {
+                'calls' : dict( (name(proc), count) for proc, count in self.calls.items() ),
+                'latency' : dict( (name(proc), histogram.snapshot())
+                        for proc, histogram in self.latency.items() ),
+                'pipeline_depth' : self.depth.snapshot(),
+                'bytes_sent' : self.bytes_sent,
+                'bytes_received' : self.bytes_received,
+                'subblocks_sent' : self.subblocks_sent,
+                'subblocks_received' : self.subblocks_received,
+                'blocks_sent' : self.blocks_sent,
+                'blocks_received' : self.blocks_received,
+                'reconnects' : self.reconnects,
+                'timeouts' : self.timeouts,
+            }
+
+    def prometheus(self, prefix = "discuss_rpc"):
+        """Returns the metrics in the Prometheus text exposition format."""
+
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(suffix, kind, help):
+            lines.append("# HELP %s_%s %s" % (prefix, suffix, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, suffix, kind))
+
+        def histogram(suffix, labels, data):
+            label = "".join('%s="%s",' % pair for pair in labels)
+            for bound, count in data['buckets']:
+                lines.append('%s_%s_bucket{%sle="%s"} %i' % (prefix, suffix, label,
+                        "+Inf" if bound == float('inf') else repr(bound), count))
+            label = "{%s}" % label.rstrip(",") if labels else ""
+            lines.append("%s_%s_sum%s %r" % (prefix, suffix, label, float(data['sum'])))
+            lines.append("%s_%s_count%s %i" % (prefix, suffix, label, data['count']))
+
+        metric("calls_total", "counter", "Requests sent, by procedure.")
+        for procedure, count in sorted(snapshot['calls'].items()):
+            lines.append('%s_calls_total{procedure="%s"} %i' % (prefix, procedure, count))
+
+        metric("latency_seconds", "histogram", "Time from queueing a request to receiving its reply.")
+        for procedure, data in sorted(snapshot['latency'].items()):
+            histogram("latency_seconds", [("procedure", procedure)], data)
+
+        metric("pipeline_depth", "histogram", "Requests in flight when a request is queued.")
+        histogram("pipeline_depth", [], snapshot['pipeline_depth'])
+
+        for name, help in (("bytes_sent", "Bytes sent, including USP framing."),
+                           ("bytes_received", "Bytes received, including USP framing."),
+                           ("subblocks_sent", "USP subblocks sent."),
+                           ("subblocks_received", "USP subblocks received."),
+                           ("blocks_sent", "USP blocks sent."),
+                           ("blocks_received", "USP blocks received."),
+                           ("reconnects", "Connections reopened."),
+                           ("timeouts", "Calls retried after a timeout.")):
+            metric(name + "_total", "counter", help)
+            lines.append("%s_%s_total %i" % (prefix, name, snapshot[name]))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,217 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the flow control for the pipelined requests.
+# Discuss has no notion of pipelining; we simply send requests ahead of time
+# and read the replies in order. The number of requests in flight (the
+# window) has to be large enough to cover the round trip time of the link,
+# but not so large that the requests pile up in the queue of a loaded server.
+#
+# The window starts small and grows by one request per reply, which doubles it
+# every round trip, for as long as the replies come back about as fast as the
+# fastest one we have seen. Once the round trip time grows noticeably, the
+# requests are queueing somewhere, and the window is cut down to the
+# bandwidth-delay product: the rate at which the replies arrive times the
+# minimal round trip time, with some headroom. The replies come in bursts,
+# so the rate is measured as the replies counted over at least one round
+# trip, not from the gaps between single replies.
+#
+# The data in flight is also kept within the socket buffers: the replies to
+# the outstanding requests have to fit into the receive buffer, and the
+# requests themselves into the send buffer. Otherwise the server may block
+# writing replies that we do not read while we block writing requests.
+#
+
+from collections import deque
+import socket
+import time
+
+# Shortest period the reply rate is measured over, in seconds
+_MIN_RATE_PERIOD = 0.005
+
+class PipelineStats(object):
+    """Measurements of a pipelined exchange."""
+
+    def __init__(self):
+        self.window = 0             # Current window, in requests
+        self.max_window = 0         # Largest window used so far
+        self.requests = 0           # Requests sent
+        self.replies = 0            # Replies received
+        self.bytes = 0              # Reply payload bytes received
+        self.rtt = None             # Smoothed round trip time, in seconds
+        self.min_rtt = None         # Smallest round trip time seen
+        self.reply_rate = None      # Replies per second (smoothed)
+        self.reply_size = None      # Average reply size, in bytes
+        self.backoffs = 0           # Number of times the window was cut
+        self.started = time.time()
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def throughput(self):
+        """Average throughput, in bytes per second."""
+
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        result = dict(self.__dict__)
+        result['elapsed'] = self.elapsed()
+        result['throughput'] = self.throughput()
+        return result
+
+    def __repr__(self):
+        return "<PipelineStats window=%i replies=%i rtt=%s rate=%s>" % (
+                self.window, self.replies, self.rtt, self.reply_rate)
+
+class FixedWindow(object):
+    """Pipelining window of a constant size."""
+
+    def __init__(self, size):
+        self.stats = PipelineStats()
+        self.stats.window = self.stats.max_window = size
+
+    @property
+    def window(self):
+        return self.stats.window
+
+    def sent(self, size = 0):
+        self.stats.requests += 1
+
+    def received(self, size):
+        self.stats.replies += 1
+        self.stats.bytes += size
+
+class AdaptiveWindow(object):
+    """Pipelining window which sizes itself from the measured round trip time
+    and reply rate. The bytes in flight are limited by max_bytes (replies)
+    and max_request_bytes (requests), which limit_to_socket() sets from the
+    buffer sizes of the connection; maximum, if set, is a hard limit on the
+    number of requests."""
+
+    def __init__(self, initial = 32, minimum = 32, maximum = None,
+                 max_bytes = None, max_request_bytes = None,
+                 queueing_factor = 2.0, headroom = 2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_bytes = max_bytes
+        self.max_request_bytes = max_request_bytes
+        self.queueing_factor = queueing_factor
+        self.headroom = headroom
+
+        self.stats = PipelineStats()
+        self.stats.window = self.stats.max_window = initial
+        self.sent_times = deque()
+        self.request_size = None
+        self.rate_start = None      # Start of the current rate measurement
+        self.rate_count = 0         # Replies received since then
+
+    @property
+    def window(self):
+        return self.stats.window
+
+    def limit_to_socket(self, sock):
+        """Limit the bytes in flight to the receive and send buffers of the
+        socket, unless the limits were given explicitly."""
+
+        try:
+            if self.max_bytes is None:
+                self.max_bytes = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            if self.max_request_bytes is None:
+                self.max_request_bytes = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        except (AttributeError, socket.error):
+            # Not a socket (e.g. the pipes of a local server)
+            pass
+
+    def sent(self, size = 0):
+        """Record that a request of the given size (if known) has been sent."""
+
+        self.sent_times.append(time.time())
+        self.stats.requests += 1
+        if size:
+            if self.request_size is None:
+                self.request_size = float(size)
+            else:
+                self.request_size += (size - self.request_size) / 8.0
+
+    def received(self, size):
+        """Record that the reply to the oldest outstanding request has been
+        received, and adjust the window."""
+
+        now = time.time()
+        stats = self.stats
+        rtt = now - self.sent_times.popleft()
+
+        stats.replies += 1
+        stats.bytes += size
+        if stats.reply_size is None:
+            stats.reply_size = float(size)
+        else:
+            stats.reply_size += (size - stats.reply_size) / 8.0
+
+        if stats.min_rtt is None or rtt < stats.min_rtt:
+            stats.min_rtt = rtt
+        if stats.rtt is None:
+            stats.rtt = rtt
+        else:
+            stats.rtt += (rtt - stats.rtt) / 8.0
+
+        if self.rate_start is None:
+            self.rate_start = now
+        else:
+            self.rate_count += 1
+            elapsed = now - self.rate_start
+            if elapsed >= max(stats.min_rtt, _MIN_RATE_PERIOD):
+                rate = self.rate_count / elapsed
+                if stats.reply_rate is None:
+                    stats.reply_rate = rate
+                else:
+                    stats.reply_rate += (rate - stats.reply_rate) / 4.0
+                self.rate_start = now
+                self.rate_count = 0
+
+        window = stats.window
+        if stats.rtt > stats.min_rtt * self.queueing_factor and stats.reply_rate:
+            # Replies slow down: the requests are queueing, so shrink the
+            # window to the bandwidth-delay product
+            bdp = stats.reply_rate * max(stats.min_rtt, 1e-6)
+            target = int(bdp * self.headroom)
+            if target < window:
+                window = target
+                stats.backoffs += 1
+                # Let the smoothed RTT reflect the new window before
+                # reacting again
+                stats.rtt = stats.min_rtt * self.queueing_factor
+        else:
+            window += 1
+
+        window = max(self.minimum, window)
+        if self.maximum is not None:
+            window = min(self.maximum, window)
+
+        # Never keep more data in flight than the socket buffers can hold,
+        # even if that means going below the minimum
+        if self.max_bytes and stats.reply_size:
+            window = min(window, int(self.max_bytes / stats.reply_size))
+        if self.max_request_bytes and self.request_size:
+            window = min(window, int(self.max_request_bytes / self.request_size))
+
+        window = max(1, window)
+        stats.window = window
+        if window > stats.max_window:
+            stats.max_window = window
+
+def make_window(window, sock = None):
+    """Turns the window argument of pipelined methods into a window object:
+    None means adaptive, an integer means fixed size, and window objects
+    are used as is. Adaptive windows are limited to the buffers of the
+    socket, if one is given."""
+
+    if window is None:
+        window = AdaptiveWindow()
+    elif isinstance(window, int):
+        return FixedWindow(window)
+    if sock is not None and hasattr(window, 'limit_to_socket'):
+        window.limit_to_socket(sock)
+    return window
@@ -0,0 +1,193 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements a pool of RPC connections, so that a
+# long-running process pays for the connection, the Kerberos handshake and
+# the who_am_i round trip once per server instead of once per operation.
+#
+# Example:
+#
+#     pool = ConnectionPool()
+#     with pool.client("charon.mit.edu") as cl:
+#         mtg = Meeting(cl, "/var/spool/discuss/vasilvv-test")
+#         mtg.load_info()
+#
+
+import select
+import socket
+import threading
+import time
+
+from .rpc import RPCClient
+from .client import Client
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available in time."""
+    pass
+
+class ConnectionPool(object):
+    """Pool of RPC connections keyed by (server, port, auth). At most
+    max_per_host connections are open to a single host, whatever the port
+    and the authentication."""
+
+    def __init__(self, max_per_host = 4, idle_timeout = 300, wait_timeout = None, RPCClient = RPCClient):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.RPCClient = RPCClient
+
+        self.condition = threading.Condition()
+        self.idle = {}      # key -> list of (connection, time it was released)
+        self.open = {}      # Canonical host name -> number of open connections, idle or not
+        self.keys = {}      # id(connection) -> key
+        self.names = {}     # Server name as given -> canonical name
+
+    def canonical_name(self, server):
+        """Returns the canonical name of the server. The name lookup is only
+        done the first time a name is seen, so checking out a pooled
+        connection does not wait for DNS."""
+
+        name = self.names.get(server)
+        if name is None:
+            name = self.names[server] = socket.getfqdn(server).lower()
+        return name
+
+    def make_key(self, server, port, auth):
+        return (self.canonical_name(server), port, auth)
+
+    def is_healthy(self, rpc, released):
+        """Checks whether the idle connection can be reused."""
+
+        if time.time() - released > self.idle_timeout:
+            return False
+
+        # Leftovers of an abandoned exchange make the connection useless
+        if rpc.outgoing or rpc.reader.available() or rpc.reader.block_type is not None:
+            return False
+
+        # An idle connection is not supposed to have anything to read. If it
+        # does, it is either closed by the server or has stray replies.
+        try:
+            readable, writable, failed = select.select([rpc.socket], [], [rpc.socket], 0)
+        except (socket.error, ValueError, select.error):
+            return False
+        return not readable and not failed
+
+    def acquire(self, server, port = 2100, auth = True, timeout = None):
+        """Borrow a connection to the server. Idle connections are reused if
+        they pass the health check; otherwise a new one is opened, unless the
+        host already has max_per_host connections, in which case an idle
+        connection to another port of the host is closed to make room, or
+        this waits for one of them to be released. The timeout applies to
+        the socket of the connection, whether it is new or reused."""
+
+        key = self.make_key(server, port, auth)
+        host = key[0]
+        deadline = time.time() + self.wait_timeout if self.wait_timeout is not None else None
+
+        with self.condition:
+            while True:
+                idle = self.idle.get(key, [])
+                while idle:
+                    rpc, released = idle.pop()
+                    if self.is_healthy(rpc, released):
+                        rpc.timeout = timeout
+                        rpc.socket.settimeout(timeout)
+                        return rpc
+                    self._discard(rpc)
+
+                if self.open.get(host, 0) >= self.max_per_host:
+                    self._discard_other_idle(key)
+
+                if self.open.get(host, 0) < self.max_per_host:
+                    self.open[host] = self.open.get(host, 0) + 1
+                    break
+
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise PoolTimeout("No connection to %s became available" % key[0])
+                    self.condition.wait(left)
+
+        try:
+            rpc = self.RPCClient(server, port, auth, timeout)
+            if rpc.socket.family in (socket.AF_INET, socket.AF_INET6):
+                rpc.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except:
+            with self.condition:
+                self.open[host] -= 1
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            self.keys[id(rpc)] = key
+        return rpc
+
+    def release(self, rpc, reusable = True):
+        """Return the connection into the pool. Connections which are not
+        reusable are closed."""
+
+        with self.condition:
+            key = self.keys.get(id(rpc))
+            if key is None:
+                raise ValueError("Connection does not belong to this pool")
+
+            if reusable:
+                self.idle.setdefault(key, []).append((rpc, time.time()))
+            else:
+                self._discard(rpc)
+            self.condition.notify()
+
+    def _discard_other_idle(self, key):
+        """Close the longest idle connection to the host of the key which
+        was opened with another port or authentication, if there is one."""
+
+        oldest = None
+        for other, idle in self.idle.items():
+            if other != key and other[0] == key[0] and idle:
+                if oldest is None or idle[0][1] < oldest[1][0][1]:
+                    oldest = (other, idle)
+        if oldest is not None:
+            rpc, released = oldest[1].pop(0)
+            self._discard(rpc)
+
+    def _discard(self, rpc):
+        key = self.keys.pop(id(rpc))
+        self.open[key[0]] -= 1
+        try:
+            rpc.socket.close()
+        except socket.error:
+            pass
+
+    def prune(self):
+        """Close all the idle connections which are no longer healthy."""
+
+        with self.condition:
+            for key, idle in self.idle.items():
+                healthy = []
+                for rpc, released in idle:
+                    if self.is_healthy(rpc, released):
+                        healthy.append((rpc, released))
+                    else:
+                        self._discard(rpc)
+                idle[:] = healthy
+            self.condition.notify_all()
+
+    def close(self):
+        """Close all the idle connections."""
+
+        with self.condition:
+            for idle in self.idle.values():
+                for rpc, released in idle:
+                    self._discard(rpc)
+            self.idle = {}
+            self.condition.notify_all()
+
+    def client(self, server, port = 2100, auth = True, timeout = None):
+        """Returns a Client which uses a connection from the pool. Closing the
+        client returns the connection to the pool."""
+
+        return Client(server, port, auth, timeout, pool = self)
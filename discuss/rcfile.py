@@ -5,7 +5,7 @@
 # See LICENSE file for more details.
 #
 
-import os, errno, re, time
+import os, errno, re, tempfile, time
 
 def locate_rc_file():
     """Determine the location of .meetings file."""
@@ -16,6 +16,25 @@ def locate_rc_file():
 
     return os.path.expanduser("~/.meetings")
 
+def locate_cache_file(name):
+    """Determine the location of the given file in the discuss cache
+    directory, following the XDG base directory specification."""
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "discuss", name)
+
+def _make_parent_directory(location):
+    """Create the directory the file is in, unless it exists already."""
+
+    directory = os.path.dirname(location)
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            # Another process may have created it first
+            if err.errno != errno.EEXIST:
+                raise err
+
 def get_default_meetings():
     """Determine the default meetings if .meetings file does not exist."""
 
@@ -93,20 +112,34 @@ class RCFile:
             self.cache[entry['location']] = (entry['hostname'], entry['path'])
 
     def save(self):
-        """Save the new .meetings file."""
-
-        rcfile = open(self.location, "w")
-        for entry in self.entries.values():
-            status = 0x00
-            if entry['changed']: status |= 0x01
-            if entry['deleted']: status |= 0x02
-
-            line = "%d:%d:%d:%s:%s:%s:\n" % (status, entry['last_timestamp'],
-                    entry['last_transaction'], entry['hostname'], entry['path'],
-                    ','.join(entry['names']))
-            rcfile.write(line)
-
-        rcfile.close()
+        """Save the new .meetings file. The file is written under a temporary
+        name and then renamed over the old one, so that a crash never leaves
+        a truncated file behind."""
+
+        directory = os.path.dirname(os.path.abspath(self.location))
+        fd, temp_path = tempfile.mkstemp(dir = directory, prefix = ".meetings")
+        try:
+            rcfile = os.fdopen(fd, "w")
+            for entry in self.entries.values():
+                status = 0x00
+                if entry['changed']: status |= 0x01
+                if entry['deleted']: status |= 0x02
+
+                line = "%d:%d:%d:%s:%s:%s:\n" % (status, entry['last_timestamp'],
+                        entry['last_transaction'], entry['hostname'], entry['path'],
+                        ','.join(entry['names']))
+                rcfile.write(line)
+            # The data has to be on disk before the rename is
+            rcfile.flush()
+            os.fsync(rcfile.fileno())
+            rcfile.close()
+
+            if os.path.exists(self.location):
+                os.chmod(temp_path, os.stat(self.location).st_mode & 0o7777)
+            os.rename(temp_path, self.location)
+        except:
+            os.unlink(temp_path)
+            raise
 
     def lookup(self, name):
         """Look up the meeting name and get a (host, path) tuple."""
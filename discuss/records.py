@@ -0,0 +1,150 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file describes the arguments and the replies of discuss
+# remote procedures as USP records. The layouts follow libds/rpcall.c; every
+# reply except GET_ACL ends with the status code ("result"), which is zero on
+# success and a discuss error code otherwise.
+#
+
+from .rpc import USPRecord
+
+# Shared layouts
+MTG_NAME = USPRecord(("name", "string"))
+
+TRN_NUMBER = USPRecord(
+    ("name", "string"),
+    ("number", "long_integer"),
+)
+
+RESULT = USPRecord(("result", "long_integer"))
+
+# GET_SERVER_VERSION
+SERVER_VERSION_REPLY = USPRecord(("version", "long_integer"))
+
+# WHO_AM_I
+WHO_AM_I_REPLY = USPRecord(("principal", "string"))
+
+# CREATE_MTG
+CREATE_MTG_REQUEST = USPRecord(
+    ("location", "string"),
+    ("long_name", "string"),
+    ("public", "boolean"),
+)
+
+# GET_MTG_INFO
+MTG_INFO_REPLY = USPRecord(
+    ("version", "long_integer"),
+    ("location", "string"),
+    ("long_name", "string"),
+    ("chairman", "string"),
+    ("first", "long_integer"),
+    ("last", "long_integer"),
+    ("lowest", "long_integer"),
+    ("highest", "long_integer"),
+    ("date_created", "long_integer"),
+    ("date_modified", "long_integer"),
+    ("public", "boolean"),
+    ("access_modes", "string"),
+    ("result", "long_integer"),
+)
+
+# UPDATED_MTG
+UPDATED_MTG_REQUEST = USPRecord(
+    ("name", "string"),
+    ("date_attended", "long_integer"),  # The server disregards this one
+    ("last", "long_integer"),
+)
+
+UPDATED_MTG_REPLY = USPRecord(
+    ("updated", "boolean"),
+    ("result", "long_integer"),
+)
+
+# GET_TRN_INFO3 takes TRN_NUMBER
+TRN_INFO_REPLY = USPRecord(
+    ("version", "long_integer"),
+    ("current", "long_integer"),
+    ("prev", "long_integer"),
+    ("next", "long_integer"),
+    ("pref", "long_integer"),
+    ("nref", "long_integer"),
+    ("fref", "long_integer"),
+    ("lref", "long_integer"),
+    ("chain_index", "long_integer"),
+    ("date_entered", "long_integer"),
+    ("num_lines", "long_integer"),
+    ("num_chars", "long_integer"),
+    ("subject", "string"),
+    ("author", "string"),
+    ("flags", "long_integer"),
+    ("signature", "string"),
+    ("result", "long_integer"),
+)
+
+# GET_TRN
+GET_TRN_REQUEST = USPRecord(
+    ("name", "string"),
+    ("number", "long_integer"),
+    ("tfile", "long_integer"),
+)
+
+# ADD_TRN and ADD_TRN2, followed by a TFILE block with the text
+ADD_TRN_REQUEST = USPRecord(
+    ("name", "string"),
+    ("length", "long_integer"),
+    ("subject", "string"),
+    ("reply_to", "long_integer"),
+)
+
+ADD_TRN2_REQUEST = USPRecord(
+    ("name", "string"),
+    ("length", "long_integer"),
+    ("subject", "string"),
+    ("signature", "string"),
+    ("reply_to", "long_integer"),
+)
+
+ADD_TRN_REPLY = USPRecord(
+    ("number", "long_integer"),
+    ("result", "long_integer"),
+)
+
+# GET_ACL takes MTG_NAME. The reply is the header followed by "length" entries.
+ACL_REPLY = USPRecord(
+    ("result", "long_integer"),
+    ("length", "long_integer"),
+)
+
+ACL_ENTRY = USPRecord(
+    ("modes", "string"),
+    ("principal", "string"),
+)
+
+# GET_ACCESS
+GET_ACCESS_REQUEST = USPRecord(
+    ("name", "string"),
+    ("principal", "string"),
+)
+
+GET_ACCESS_REPLY = USPRecord(
+    ("modes", "string"),
+    ("result", "long_integer"),
+)
+
+# SET_ACCESS
+SET_ACCESS_REQUEST = USPRecord(
+    ("name", "string"),
+    ("principal", "string"),
+    ("modes", "string"),
+)
+
+# DELETE_TRN and RETRIEVE_TRN take TRN_NUMBER and reply with RESULT
+
+# SET_TRN_FLAGS replies with RESULT
+SET_TRN_FLAGS_REQUEST = USPRecord(
+    ("name", "string"),
+    ("number", "long_integer"),
+    ("flags", "long_integer"),
+)
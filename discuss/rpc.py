@@ -41,18 +41,29 @@
 # exported in the header file. On, and the whole suite is written in K&R C.
 #
 
+from collections import deque
 import errno
 import fcntl
+import os
 import socket
-from struct import pack, unpack, calcsize
+from struct import Struct, pack
 import subprocess
-from functools import partial
+import time
 
 from . import constants
 
 class ProtocolError(Exception):
     pass
 
+class ConnectionBusy(ProtocolError):
+    """Raised when the connection is used while it has the replies of a
+    pipelined iteration in flight (e.g. from the body of a loop over
+    Meeting.iter_transactions())."""
+    pass
+
+_BUSY_MESSAGE = ("The connection is in the middle of a pipelined iteration; finish or "
+                 "close the iterator first, or use another connection")
+
 # Data formats, in their USP names. USP "cardinal" means "unsigned" or something
 # like that (discuss rpcall.c calls it "short", which is more reasonable).
 _formats = {
@@ -63,6 +74,36 @@ _formats = {
     "long_cardinal" : "!I",
 }
 
+_cardinal = Struct("!H")
+
+# Note that the receiving side deliberately allows larger subblocks than the
+# ones we send, because some of the code suggests that blocks larger than 512
+# bytes may actually exist
+_MAX_SUBBLOCK = 4096
+
+# Amount of queued outgoing data after which it is sent without waiting for
+# an explicit flush
+_FLUSH_THRESHOLD = 65536
+
+def _encode_string(s):
+    """Converts a string into its USP wire representation, without the length
+    prefix and the padding."""
+
+    if "\0" in s:
+        raise ProtocolError("Null characeters are not allowed in USP")
+
+    # "\n" is translated to "\r\n", and "\r" to "\r\0". Because we can. Or
+    # because that seemed like a nice cross-platform feature. Or for weird
+    # technical reasons from 1980s I do not really want to know. This works
+    # out because input is null-terminated and wire format is has length
+    # specified.
+    return s.encode().replace(b"\r", b"\r\0").replace(b"\n", b"\r\n")
+
+def _decode_string(encoded):
+    """Inverse of _encode_string()."""
+
+    return encoded.replace(b"\r\n", b"\n").replace(b"\r\0", b"\r").decode()
+
 # This is a horrible kludge which I wrote for pymoira and hoped to forget that
 # it exists and that I ever wrote it. Unfortunately, it looks like Moira is not
 # the only Athena service which totally disregards such nice thing like GSSAPI.
@@ -108,19 +149,15 @@ class USPBlock(object):
     """Class which allows to build USP blocks."""
 
     def __init__(self, block_type):
-        # Create read_* and put_* methods
-        self.__dict__.update({
-                ("put_" + name) : partial(self.put_data, fmt)
-                for name, fmt in _formats.items()
-            })
-        self.__dict__.update({
-                ("read_" + name) : partial(self.read_data, fmt)
-                for name, fmt in _formats.items()
-            })
-
         self.buffer = b""
         self.block_type = block_type
 
+        # Read cursor. Replies are decoded by moving the offset through a
+        # memoryview of the buffer instead of slicing the tail off on every
+        # field, which used to make decoding quadratic in the reply size.
+        self.offset = 0
+        self.view = None
+
     def put_data(self, fmt, s):
         """Put formatted data into the buffer."""
 
@@ -129,15 +166,7 @@ class USPBlock(object):
     def put_string(self, s):
         """Put a string into the buffer."""
 
-        if "\0" in s:
-            raise USPError("Null characeters are not allowed in USP")
-
-        # "\n" is translated to "\r\n", and "\r" to "\r\0". Because we can. Or
-        # because that seemed like a nice cross-platform feature. Or for weird
-        # technical reasons from 1980s I do not really want to know. This works
-        # out because input is null-terminated and wire format is has length
-        # specified.
-        encoded = s.encode().replace(b"\r", b"\r\0").replace(b"\n", b"\r\n")
+        encoded = _encode_string(s)
         self.put_cardinal(len(encoded))
         self.buffer += encoded
 
@@ -145,44 +174,66 @@ class USPBlock(object):
         if len(encoded) % 2 == 1:
             self.buffer += b"\0"
 
-    def send(self, sock):
-        """Sends the block over a socket."""
+    def encode(self):
+        """Returns the list of buffers which make up the wire representation
+        of the block. The data itself is not copied."""
 
         # Maximum size of a subblock (MAX_SUB_BLOCK_LENGTH)
         magic_number = 508
 
-        sock.sendall(pack("!H", self.block_type))
+        parts = [_cardinal.pack(self.block_type)]
 
         # Each block is fragmented into subblocks with a 16-bit header
-        unsent = self.buffer
-        first_pass = True
-        while len(unsent) > 0 or first_pass:
-            first_pass = False
-
-            if len(unsent) > magic_number:
-                current, unsent = unsent[0:magic_number], unsent[magic_number:]
-                last = False
-            else:
-                current, unsent = unsent, ""
-                last = True
+        data = memoryview(self.buffer)
+        length = len(data)
+        position = 0
+        while True:
+            current = data[position:position + magic_number]
+            position += len(current)
+            last = position >= length
 
             # Header is length of the subblock + last block marker
             header_number = len(current) + 2   # Length + header size
-            if last: 
+            if last:
                 header_number |= 0x8000
-            header = pack("!H", header_number)
 
-            sock.sendall(header + current)
+            parts.append(_cardinal.pack(header_number))
+            if current:
+                parts.append(current)
+            if last:
+                return parts
+
+    def send(self, sock):
+        """Sends the block over a socket."""
+
+        sock.sendall(b"".join(self.encode()))
+
+    def reader_view(self):
+        """Returns a memoryview of the buffer for the read cursor. The view is
+        recreated if the buffer has been replaced since the last read."""
+
+        if self.view is None or self.view.obj is not self.buffer:
+            self.view = memoryview(self.buffer)
+        return self.view
+
+    def remaining(self):
+        """Number of bytes which have not been read from the block yet."""
+
+        return len(self.buffer) - self.offset
 
     def read_data(self, fmt):
         """Read a data using a type specifier."""
 
-        size = calcsize(fmt)
-        if len(self.buffer) < size:
+        return self.read_struct(Struct(fmt))
+
+    def read_struct(self, st):
+        """Read a single value using a precompiled struct."""
+
+        if self.remaining() < st.size:
             raise ProtocolError("Invalid data received from the client (block is too short)")
-        
-        data, self.buffer = self.buffer[0:size], self.buffer[size:]
-        unpacked, = unpack(fmt, data)
+
+        unpacked, = st.unpack_from(self.reader_view(), self.offset)
+        self.offset += st.size
         return unpacked
 
     def read_string(self):
@@ -190,98 +241,396 @@ class USPBlock(object):
 
         size = self.read_cardinal()
 
-        if len(self.buffer) < size:
+        if self.remaining() < size:
             raise ProtocolError("Invalid data received from the client (block is too short)")
         omit = size + 1 if size % 2 ==1 else size  # due to padding
-        encoded, self.buffer = self.buffer[0:size], self.buffer[omit:]
+        start = self.offset
+        # Only the string itself is copied out of the view
+        encoded = self.reader_view()[start:start + size].tobytes()
+        self.offset = min(start + omit, len(self.buffer))
 
-        return encoded.replace(b"\r\n", b"\n").replace(b"\r\0", b"\r").decode()
+        return _decode_string(encoded)
 
     @staticmethod
     def receive(sock):
-        """Receives a block sent over the network."""
+        """Receives a block sent over the network. This reads the socket
+        directly without any buffering; RPCClient uses USPReader instead."""
 
-        header = sock.recv(2)
-        block_type, = unpack("!H", header)
-        block = USPBlock(block_type)
-
-        # Note that here I deliberately increase the size compared to send()
-        # because some of the code suggests that blocks larger than 512 bytes
-        # may actually exist
-        magic_number = 4096
+        block_type, = _cardinal.unpack(_recv_exactly(sock, 2))
 
         last = False
+        buffer = bytearray()
         while not last:
-            subheader, = unpack("!H", sock.recv(2))
+            subheader, = _cardinal.unpack(_recv_exactly(sock, 2))
             last = (subheader & 0x8000) != 0
             size = (subheader & 0x0FFF) - 2
-            if size > magic_number:
+            if size > _MAX_SUBBLOCK:
                 raise ProtocolError("Subblock size is too large")
 
-            buffer = b""
-            while len(buffer) < size:
-                old_len = len(buffer)
-                buffer += sock.recv(size - len(buffer))
-                if len(buffer) == old_len:
-                    raise ProtocolError("Connection broken while transmitting a block")
+            buffer += _recv_exactly(sock, size)
 
-            block.buffer += buffer
+        block = USPBlock(block_type)
+        block.buffer = bytes(buffer)
+        return block
 
+def _recv_exactly(sock, size):
+    """Reads exactly size bytes from the socket."""
+
+    buffer = bytearray()
+    while len(buffer) < size:
+        data = sock.recv(size - len(buffer))
+        if not data:
+            raise ProtocolError("Connection broken while transmitting a block")
+        buffer += data
+    return bytes(buffer)
+
+class USPReader(object):
+    """Per-connection read buffer which assembles USP blocks out of a byte
+    stream.
+
+    The data is read with large recv_into() calls into a preallocated
+    bytearray, so one read usually contains many pipelined replies, and the
+    headers split between two reads are handled by simply waiting for more
+    data. The reader itself does not touch the socket except in fill(), so
+    it can be used with any transport which can write into a buffer."""
+
+    def __init__(self, size = 65536):
+        # Any incomplete subblock must fit into the buffer alongside its
+        # headers
+        if size < _MAX_SUBBLOCK + 4:
+            raise ValueError("Read buffer is too small")
+
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+        # State of the block which is being assembled
+        self.block_type = None
+        self.pending = None
+
+        # Wire bytes and subblocks parsed so far, for the metrics
+        self.parsed = 0
+        self.subblocks = 0
+
+    def available(self):
+        """Number of bytes received but not parsed yet."""
+
+        return self.end - self.start
+
+    def writable(self):
+        """Returns the free space at the end of the buffer as a memoryview,
+        moving the unparsed data to the beginning of the buffer if needed."""
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < _MAX_SUBBLOCK + 4:
+            length = self.end - self.start
+            self.buffer[0:length] = self.view[self.start:self.end].tobytes()
+            self.start, self.end = 0, length
+
+        return self.view[self.end:]
+
+    def commit(self, size):
+        """Marks size bytes written into writable() as received."""
+
+        self.end += size
+
+    def fill(self, sock):
+        """Reads as much as is available from the socket in one call."""
+
+        received = sock.recv_into(self.writable())
+        if received == 0:
+            raise ProtocolError("Connection broken while transmitting a block")
+        self.commit(received)
+
+    def next_subblock(self):
+        """Parses the next subblock out of the buffer. Returns a (block type,
+        payload, last) tuple, or None if more data has to be received first.
+        The payload is a memoryview into the read buffer, and is only valid
+        until the next call to writable()."""
+
+        if self.block_type is None:
+            if self.available() < 2:
+                return None
+            self.block_type, = _cardinal.unpack_from(self.view, self.start)
+            self.start += 2
+            self.parsed += 2
+
+        if self.available() < 2:
+            return None
+        subheader, = _cardinal.unpack_from(self.view, self.start)
+        size = (subheader & 0x0FFF) - 2
+        if size > _MAX_SUBBLOCK:
+            raise ProtocolError("Subblock size is too large")
+        if size < 0:
+            raise ProtocolError("Invalid subblock header")
+        if self.available() < size + 2:
+            return None
+
+        payload = self.view[self.start + 2:self.start + 2 + size]
+        self.start += size + 2
+        self.parsed += size + 2
+        self.subblocks += 1
+
+        block_type = self.block_type
+        last = (subheader & 0x8000) != 0
+        if last:
+            self.block_type = None
+        return block_type, payload, last
+
+    def next_block(self):
+        """Parses the next complete block out of the buffer. Returns None if
+        more data has to be received first."""
+
+        while True:
+            subblock = self.next_subblock()
+            if subblock is None:
+                return None
+
+            block_type, payload, last = subblock
+            if last and self.pending is None:
+                # Most replies fit into a single subblock
+                buffer = payload.tobytes()
+            else:
+                if self.pending is None:
+                    self.pending = bytearray()
+                self.pending += payload
+                if not last:
+                    continue
+                buffer, self.pending = self.pending, None
+
+            block = USPBlock(block_type)
+            block.buffer = buffer
+            return block
+
+    def receive(self, sock):
+        """Returns the next block, reading from the socket as needed."""
+
+        block = self.next_block()
+        while block is None:
+            self.fill(sock)
+            block = self.next_block()
         return block
 
+# Create read_* and put_* methods for every USP data type
+def _make_accessors(fmt):
+    st = Struct(fmt)
+    def put(self, s):
+        self.buffer += st.pack(s)
+    def read(self):
+        return self.read_struct(st)
+    return put, read
+
+for _name, _fmt in _formats.items():
+    _put, _read = _make_accessors(_fmt)
+    _put.__name__, _read.__name__ = "put_" + _name, "read_" + _name
+    setattr(USPBlock, "put_" + _name, _put)
+    setattr(USPBlock, "read_" + _name, _read)
+
+class USPRecord(object):
+    """Declarative description of a sequence of USP fields.
+
+    Fields are given as (name, type) pairs, where type is either "string" or
+    one of the USP integer types.  Consecutive fixed-width fields are compiled
+    into a single precompiled struct, so that a whole reply is decoded in one
+    pass instead of one method call per field."""
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.names = tuple(name for name, kind in fields)
+
+        # Each step is either a (Struct, field count) pair for a run of
+        # integers, or (None, 1) for a string
+        self.steps = []
+        run = ""
+        for name, kind in fields:
+            if kind == "string":
+                if run:
+                    self.steps.append((Struct("!" + run), len(run)))
+                    run = ""
+                self.steps.append((None, 1))
+            else:
+                run += _formats[kind][1:]
+        if run:
+            self.steps.append((Struct("!" + run), len(run)))
+
+    def unpack(self, block):
+        """Decode the record from the current position of the block. Returns
+        the list of values in the order of fields."""
+
+        view = block.reader_view()
+        offset = block.offset
+        end = len(block.buffer)
+        values = []
+        for step, count in self.steps:
+            if step is None:
+                if end - offset < 2:
+                    raise ProtocolError("Invalid data received from the client (block is too short)")
+                size, = _cardinal.unpack_from(view, offset)
+                offset += 2
+                if end - offset < size:
+                    raise ProtocolError("Invalid data received from the client (block is too short)")
+                values.append(_decode_string(view[offset:offset + size].tobytes()))
+                offset += size + (size & 1)   # due to padding
+            else:
+                if end - offset < step.size:
+                    raise ProtocolError("Invalid data received from the client (block is too short)")
+                values.extend(step.unpack_from(view, offset))
+                offset += step.size
+
+        block.offset = min(offset, end)
+        return values
+
+    def read(self, block):
+        """Decode the record into a dictionary."""
+
+        return dict(zip(self.names, self.unpack(block)))
+
+    def pack(self, block, *values):
+        """Encode the values (in the order of fields) into the block."""
+
+        if len(values) != len(self.fields):
+            raise ValueError("Record has %i fields, %i values given" % (len(self.fields), len(values)))
+
+        parts = []
+        position = 0
+        for step, count in self.steps:
+            if step is None:
+                encoded = _encode_string(values[position])
+                parts.append(_cardinal.pack(len(encoded)))
+                parts.append(encoded)
+                if len(encoded) % 2 == 1:
+                    parts.append(b"\0")
+                position += 1
+            else:
+                parts.append(step.pack(*values[position:position + count]))
+                position += count
+
+        block.buffer += b"".join(parts)
+
+def make_auth_block(server, auth):
+    """Builds the KRB_TICKET block which opens every discuss connection."""
+
+    auth_block = USPBlock(constants.KRB_TICKET)
+    if auth:
+        authenticator = _get_krb5_ap_req( "discuss", server )
+
+        # Discuss does the same thing for authentication as Moira does: it
+        # sends AP_REQ to the server and prays that we do not get MITMed,
+        # and that Kerberos will protect us from possible replay attacks on
+        # that and what else. In Moira it was disappointing given that
+        # GSSAPI exists for ~20 years and Moira was reasonably maintained
+        # in general. I'm not judging discuss much, because it did not
+        # receive much care since it was originally developed.
+        # 
+        # What fascinates me here is the way discuss decided to improve on
+        # the Moira's authentication protocol. Instead of just sending the
+        # Kerberos ticket, it represents it as an array of bytes, and then
+        # it takes every byte and converts it into a network-order short.
+        #
+        # My current hypothesis is that this is because USP does not
+        # support bytes and sending things as an array of shorts seemed
+        # like the easiest way to use the underlying buffer-control
+        # routines.
+        #
+        # You may bemoan the state of computer science, but looking at
+        # this, I feel like we became better at protocol design over last
+        # 20 years.
+
+        auth_block.put_cardinal(len(authenticator))
+        for byte in authenticator:
+            if str == bytes:
+                byte = ord(byte)
+            auth_block.put_cardinal(byte)
+    else:
+        auth_block.put_cardinal(0)
+
+    return auth_block
+
+def spawn_local_server(cmd):
+    """Starts a local disserve binary and returns the socket connected to its
+    standard input."""
+
+    pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    subprocess.Popen([cmd], stdin=pair[1], close_fds=True)
+    pair[1].close()
+    fcntl.fcntl(pair[0].fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return pair[0]
+
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+
+def _send_vectored(sock, buffers):
+    """Writes all the buffers into the socket, using as few sendmsg() calls as
+    possible."""
+
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers]
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + _IOV_MAX])
+
+        # Skip over everything that was written, which might have ended in
+        # the middle of a buffer
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        if sent:
+            buffers[index] = buffers[index][sent:]
+
 class RPCClient(object):
+    # Metrics object the traffic is reported to (see discuss.metrics), if any
+    metrics = None
+
+    # Capture the traffic is recorded into (see discuss.capture), if any
+    capture = None
+
+    # Set while an iterator which has requests in flight on the connection
+    # is suspended; any other use of the connection would take its replies
+    busy = False
+
     def __init__(self, server, port, auth = True, timeout = None):
         self.server = socket.getfqdn(server).lower()
         self.port = port
         self.auth = auth
         self.timeout = timeout
 
-        self.connect()
         self.make_wrapper()
+        self.connect()
 
     def connect(self):
         self.socket = socket.create_connection((self.server, self.port), self.timeout)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reset_state()
 
-        if not hasattr(self, 'wrapper'):
-            self.wrapper = self.socket
-
-        auth_block = USPBlock(constants.KRB_TICKET)
-        if self.auth:
-            authenticator = _get_krb5_ap_req( "discuss", self.server )
-
-            # Discuss does the same thing for authentication as Moira does: it
-            # sends AP_REQ to the server and prays that we do not get MITMed,
-            # and that Kerberos will protect us from possible replay attacks on
-            # that and what else. In Moira it was disappointing given that
-            # GSSAPI exists for ~20 years and Moira was reasonably maintained
-            # in general. I'm not judging discuss much, because it did not
-            # receive much care since it was originally developed.
-            # 
-            # What fascinates me here is the way discuss decided to improve on
-            # the Moira's authentication protocol. Instead of just sending the
-            # Kerberos ticket, it represents it as an array of bytes, and then
-            # it takes every byte and converts it into a network-order short.
-            #
-            # My current hypothesis is that this is because USP does not
-            # support bytes and sending things as an array of shorts seemed
-            # like the easiest way to use the underlying buffer-control
-            # routines.
-            #
-            # You may bemoan the state of computer science, but looking at
-            # this, I feel like we became better at protocol design over last
-            # 20 years.
-
-            auth_block.put_cardinal(len(authenticator))
-            for byte in authenticator:
-                if str == bytes:
-                    byte = ord(byte)
-                auth_block.put_cardinal(byte)
-        else:
-            auth_block.put_cardinal(0)
-
+        auth_block = make_auth_block(self.server, self.auth)
         self.send(auth_block)
 
+    def reset_state(self):
+        """Sets up the buffers for a new connection. Whatever was queued or
+        in flight on the old one is lost."""
+
+        if self.metrics is not None and hasattr(self, 'reader'):
+            self.metrics.reconnected()
+
+        self.reader = USPReader()
+        self.outgoing = []
+        self.outgoing_size = 0
+
+        # Requests sent but not replied to, as (procedure, time) pairs, and
+        # the reader counters which have been reported; only kept with metrics
+        self.in_flight = deque()
+        self.reported = (0, 0)
+
+        if self.capture is not None:
+            self.wrapper.connected(self.server)
+
     def make_wrapper(self):
         class SocketWrapper(object):
             def recv(self2, *args, **kwargs):
@@ -293,6 +642,24 @@ class RPCClient(object):
                     else:
                         raise err
 
+            def recv_into(self2, *args, **kwargs):
+                try:
+                    return self.socket.recv_into(*args, **kwargs)
+                except socket.error as err:
+                    if err.errno == errno.EINTR:
+                        return self2.recv_into(*args, **kwargs)
+                    else:
+                        raise err
+
+            def sendmsg(self2, *args, **kwargs):
+                try:
+                    return self.socket.sendmsg(*args, **kwargs)
+                except socket.error as err:
+                    if err.errno == errno.EINTR:
+                        return self2.sendmsg(*args, **kwargs)
+                    else:
+                        raise err
+
             def sendall(self2, *args, **kwargs):
                 try:
                     return self.socket.sendall(*args, **kwargs)
@@ -303,12 +670,96 @@ class RPCClient(object):
                         raise err
 
         self.wrapper = SocketWrapper()
+        if self.capture is not None:
+            self.wrapper = self.capture.wrap(self.wrapper)
+
+    def queue(self, block):
+        """Adds the block to the outgoing queue without sending it. The queue
+        is written out with a single vectored write when it grows large, on
+        flush(), or before anything is received, so the pipelined requests
+        share the packets instead of sending one each. Returns the size of
+        the encoded block."""
+
+        if self.busy:
+            raise ConnectionBusy(_BUSY_MESSAGE)
+
+        parts = block.encode()
+        size = sum(len(part) for part in parts)
+        self.outgoing.extend(parts)
+        self.outgoing_size += size
+        if self.metrics is not None:
+            self.record_sent(block, size)
+        if self.outgoing_size >= _FLUSH_THRESHOLD:
+            self.flush()
+        return size
+
+    def flush(self):
+        """Sends all the queued blocks."""
+
+        if not self.outgoing:
+            return
+
+        outgoing = self.outgoing
+        self.outgoing = []
+        self.outgoing_size = 0
+        _send_vectored(self.wrapper, outgoing)
 
     def send(self, block):
-        block.send(self.wrapper)
+        self.queue(block)
+        self.flush()
 
     def receive(self):
-        return USPBlock.receive(self.wrapper)
+        if self.busy:
+            raise ConnectionBusy(_BUSY_MESSAGE)
+        self.flush()
+        block = self.reader.receive(self.wrapper)
+        if self.metrics is not None:
+            self.record_received(block.block_type)
+        return block
+
+    def record_sent(self, block, size):
+        subblocks = max(1, (len(block.buffer) + 507) // 508)
+        procedure = block.block_type - constants.PROC_BASE
+        if 0 < procedure < constants.REPLY_TYPE - constants.PROC_BASE:
+            self.in_flight.append((procedure, time.time()))
+            self.metrics.block_sent(size, subblocks, procedure, len(self.in_flight))
+        else:
+            self.metrics.block_sent(size, subblocks)
+
+    def record_received(self, block_type):
+        reader = self.reader
+        parsed, subblocks = self.reported
+        self.reported = (reader.parsed, reader.subblocks)
+        size, subblocks = reader.parsed - parsed, reader.subblocks - subblocks
+
+        # The replies come in the order of the requests; TFILE blocks which
+        # precede some replies are not replies themselves
+        if block_type == constants.REPLY_TYPE and self.in_flight:
+            procedure, sent = self.in_flight.popleft()
+            self.metrics.block_received(size, subblocks, procedure, time.time() - sent)
+        else:
+            self.metrics.block_received(size, subblocks)
+
+    def receive_subblocks(self):
+        """Iterate over the subblocks of the next block as they arrive, as
+        (block type, payload, last) tuples, without assembling the block.
+        The payload is a memoryview into the read buffer, and is only valid
+        until the iterator is resumed. The iterator has to be exhausted
+        before anything else is received."""
+
+        if self.busy:
+            raise ConnectionBusy(_BUSY_MESSAGE)
+        self.flush()
+        while True:
+            subblock = self.reader.next_subblock()
+            if subblock is None:
+                self.reader.fill(self.wrapper)
+                continue
+            yield subblock
+            if subblock[2]:
+                if self.metrics is not None:
+                    self.record_received(subblock[0])
+                return
 
     def request(self, block):
         block.block_type += constants.PROC_BASE
@@ -327,13 +778,13 @@ class RPCLocalClient(RPCClient):
         if port == 2100:
             port = '/usr/sbin/disserve'
         self.cmd = port
+        self.port = port
+        self.auth = auth
+        self.timeout = timeout
 
-        self.connect()
         self.make_wrapper()
+        self.connect()
 
     def connect(self):
-        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
-        subprocess.Popen([self.cmd], stdin=pair[1], close_fds=True)
-        pair[1].close()
-        fcntl.fcntl(pair[0].fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-        self.socket = pair[0]
+        self.socket = spawn_local_server(self.cmd)
+        self.reset_state()
@@ -0,0 +1,244 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the full-text search over the meetings. The
+# subjects and texts of the transactions are split into words, and for every
+# word the index records the transactions which contain it, together with
+# the positions of the word in them, so that phrases can be matched as well.
+# The index lives in an SQLite database next to the transaction store.
+#
+# Every meeting is indexed up to some transaction number; indexing it again
+# only reads the transactions after that. With a TransactionStore attached to
+# the meeting, the texts which have already been fetched are taken from the
+# store.
+#
+# Example:
+#
+#     index = SearchIndex()
+#     index.index_meeting(mtg)
+#     for mtg_id, number in index.search('kerberos "ticket expired"'):
+#         print(mtg_id, number)
+#
+
+import re
+import sqlite3
+import struct
+import threading
+
+from .rcfile import locate_cache_file, _make_parent_directory
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meetings (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    last INTEGER NOT NULL,
+    PRIMARY KEY (host, path)
+);
+
+CREATE TABLE IF NOT EXISTS documents (
+    doc INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    UNIQUE (host, path, number)
+);
+
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+"""
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+def tokenize(text):
+    """Split the text into a list of lowercase words."""
+
+    return [word.lower() for word in _WORD.findall(text)]
+
+# Positions are stored as little-endian 32-bit integers, so that the index
+# can be read on any architecture
+def _encode_positions(positions):
+    return sqlite3.Binary(struct.pack("<%iI" % len(positions), *positions))
+
+def _decode_positions(blob):
+    return struct.unpack("<%iI" % (len(blob) // 4), bytes(blob))
+
+class SearchIndex(object):
+    """Inverted index of the subjects and texts of transactions, keyed by the
+    meeting id (a (host, path) tuple) and the transaction number."""
+
+    def __init__(self, location = None):
+        self.location = location or locate_cache_file("search.sqlite3")
+        _make_parent_directory(self.location)
+
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.location, check_same_thread = False)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def last_indexed(self, mtg_id):
+        """Returns the number of the last transaction of the meeting which has
+        been indexed, or 0."""
+
+        with self.lock:
+            row = self.db.execute("SELECT last FROM meetings WHERE host = ? AND path = ?",
+                    mtg_id).fetchone()
+        return row[0] if row else 0
+
+    def add(self, mtg_id, documents, last = None):
+        """Index the documents, given as (number, subject, text) triples, and
+        record that the meeting is indexed up to last (by default, the
+        largest of the numbers). Documents which are already indexed are
+        replaced."""
+
+        with self.lock, self.db:
+            indexed = self.last_indexed(mtg_id)
+            for number, subject, text in documents:
+                self._add_document(mtg_id, number, subject, text)
+                indexed = max(indexed, number)
+
+            if last is not None:
+                indexed = max(indexed, last)
+            self.db.execute("INSERT OR REPLACE INTO meetings VALUES (?, ?, ?)",
+                    mtg_id + (indexed,))
+
+    def _add_document(self, mtg_id, number, subject, text):
+        self._remove_document(mtg_id, number)
+        cursor = self.db.execute("INSERT INTO documents (host, path, number) VALUES (?, ?, ?)",
+                mtg_id + (number,))
+        doc = cursor.lastrowid
+
+        # The subject and the text are numbered as if they were separated by
+        # a word, so that a phrase does not match across them
+        words = tokenize(subject) + [None] + tokenize(text)
+        positions = {}
+        for position, word in enumerate(words):
+            if word is not None:
+                positions.setdefault(word, []).append(position)
+
+        self.db.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                [(word, doc, _encode_positions(where)) for word, where in positions.items()])
+
+    def _remove_document(self, mtg_id, number):
+        row = self.db.execute("SELECT doc FROM documents WHERE host = ? AND path = ? AND number = ?",
+                mtg_id + (number,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM postings WHERE doc = ?", row)
+        self.db.execute("DELETE FROM documents WHERE doc = ?", row)
+
+    def remove_meeting(self, mtg_id):
+        """Drop everything indexed for the meeting."""
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM postings WHERE doc IN "
+                    "(SELECT doc FROM documents WHERE host = ? AND path = ?)", mtg_id)
+            self.db.execute("DELETE FROM documents WHERE host = ? AND path = ?", mtg_id)
+            self.db.execute("DELETE FROM meetings WHERE host = ? AND path = ?", mtg_id)
+
+    def index_meeting(self, meeting, end = -1, batch = 500, feedback = None, window = None):
+        """Fetch the texts of the transactions after the last indexed one and
+        add them to the index, committing every batch transactions, so that
+        an interrupted run keeps what it has done. Returns the number of
+        transactions indexed."""
+
+        start = self.last_indexed(meeting.id) + 1
+        if end == -1:
+            meeting.load_info(force = True)
+            end = meeting.last
+        if start > end:
+            return 0
+
+        count = 0
+        pending = []
+        source = meeting.get_texts(start, end, feedback = feedback, window = window)
+        try:
+            for trn, text in source:
+                pending.append((trn.number, trn.subject, text))
+                if len(pending) >= batch:
+                    self.add(meeting.id, pending)
+                    count += len(pending)
+                    pending = []
+        finally:
+            source.close()
+
+        # Deleted transactions at the end are skipped, but they are done
+        self.add(meeting.id, pending, last = end)
+        return count + len(pending)
+
+    def _postings(self, term, meetings):
+        """Returns the dictionary mapping the documents which contain the
+        term to the positions of the term in them."""
+
+        statement = "SELECT p.doc, p.positions FROM postings p"
+        arguments = [term]
+        if meetings is not None:
+            statement += " JOIN documents d ON d.doc = p.doc WHERE p.term = ? AND (%s)" % \
+                    " OR ".join(["(d.host = ? AND d.path = ?)"] * len(meetings))
+            for mtg_id in meetings:
+                arguments.extend(mtg_id)
+        else:
+            statement += " WHERE p.term = ?"
+
+        with self.lock:
+            return dict( (doc, _decode_positions(positions))
+                    for doc, positions in self.db.execute(statement, arguments) )
+
+    def search(self, query, meetings = None):
+        """Find the transactions which contain all the words of the query.
+        Words in double quotes have to appear as a phrase. If meetings (a
+        list of meeting ids) is given, only those meetings are searched.
+        Returns the list of (meeting id, transaction number) pairs, in order."""
+
+        phrases = []
+        for quoted, word in _QUERY_PART.findall(query):
+            words = tokenize(quoted if quoted else word)
+            if words:
+                phrases.append(words)
+        if not phrases or (meetings is not None and not meetings):
+            return []
+
+        postings = {}
+        for term in set(word for phrase in phrases for word in phrase):
+            postings[term] = self._postings(term, meetings)
+
+        # Intersect starting from the rarest word
+        terms = sorted(postings, key = lambda term: len(postings[term]))
+        docs = set(postings[terms[0]])
+        for term in terms[1:]:
+            docs.intersection_update(postings[term])
+            if not docs:
+                return []
+
+        for phrase in phrases:
+            if len(phrase) > 1:
+                docs = set(doc for doc in docs if self._has_phrase(doc, phrase, postings))
+
+        if not docs:
+            return []
+
+        # SQLite limits the number of parameters of a statement
+        docs = sorted(docs)
+        rows = []
+        with self.lock:
+            for i in range(0, len(docs), 500):
+                chunk = docs[i:i + 500]
+                rows += self.db.execute("SELECT host, path, number FROM documents WHERE doc IN (%s)" %
+                        ", ".join("?" * len(chunk)), chunk).fetchall()
+        return sorted(((host, path), number) for host, path, number in rows)
+
+    def _has_phrase(self, doc, phrase, postings):
+        candidates = set(postings[phrase[0]][doc])
+        for offset, word in enumerate(phrase[1:], 1):
+            following = set(position - offset for position in postings[word][doc])
+            candidates.intersection_update(following)
+            if not candidates:
+                return False
+        return True
@@ -0,0 +1,842 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements a stand-in discuss server, which speaks the
+# same protocol as disserve but keeps everything in this process. It exists
+# so that the client can be exercised (in tests, benchmarks, or just to see
+# how it behaves on a slow link) without a real server around.
+#
+# The meetings are kept in a store: either in memory (MemoryMeetingStore),
+# or in an SQLite database (SQLiteMeetingStore), so that a populated server
+# can be reused between runs. The server itself implements the semantics of
+# the procedures on top of the store: numbering, the reply chains, deletion
+# and the access control lists. Access is not enforced; everyone is
+# identified as the principal of the server.
+#
+# The server answers either on a TCP port (listen()), where the ordinary
+# RPCClient can connect to it with auth = False, or over a socketpair, as the
+# local disserve does for RPCLocalClient (client_class()). Every connection
+# is served by its own thread, which reads all the pipelined requests
+# available, and sends all the replies together.
+#
+# The replies can be delayed (latency, in seconds after the request has been
+# read) and throttled (bandwidth, in bytes per second), to see how the client
+# behaves when the server is far away.
+#
+# Example:
+#
+#     server = DiscussServer(latency = 0.05)
+#     server.create_meeting("/var/spool/discuss/test", "Test meeting")
+#     server.add_transaction("/var/spool/discuss/test", "Hello\n", "Greetings")
+#
+#     cl = Client("localhost", RPCClient = server.client_class())
+#     mtg = Meeting(cl, "/var/spool/discuss/test")
+#
+
+from collections import deque
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .client import DiscussError
+from .rpc import USPBlock, USPReader, RPCClient, ProtocolError
+from . import constants, records
+
+# All the access modes which may appear on an ACL
+ACCESS_MODES = "acdorsw"
+
+# Access given to the creator of a meeting, and to everyone if it is public
+CHAIRMAN_MODES = "acdorsw"
+PUBLIC_MODES = "aorsw"
+
+# Largest piece written at once when the bandwidth is limited
+_THROTTLE_CHUNK = 4096
+
+def _new_transaction(number, text, subject, author, signature, date):
+    return {
+        'number' : number,
+        'pref' : 0,
+        'nref' : 0,
+        'fref' : number,
+        'lref' : number,
+        'chain_index' : 1,
+        'date_entered' : date,
+        'num_lines' : text.count(b"\n"),
+        'num_chars' : len(text),
+        'subject' : subject,
+        'author' : author,
+        'signature' : signature,
+        'flags' : 0,
+        'deleted' : False,
+        'text' : text,
+    }
+
+class MemoryMeetingStore(object):
+    """Meetings kept in dictionaries. Lost when the process exits."""
+
+    def __init__(self):
+        self.meetings = {}      # Name -> (info, ACL, transactions)
+
+    def get_meeting(self, name):
+        meeting = self.meetings.get(name)
+        return dict(meeting[0]) if meeting else None
+
+    def put_meeting(self, name, info):
+        meeting = self.meetings.get(name)
+        if meeting:
+            meeting[0].update(info)
+        else:
+            self.meetings[name] = (dict(info), {}, {})
+
+    def remove_meeting(self, name):
+        self.meetings.pop(name, None)
+
+    def meeting_names(self):
+        return sorted(self.meetings)
+
+    def get_acl(self, name):
+        return list(self.meetings[name][1].items())
+
+    def set_access(self, name, principal, modes):
+        """Set the modes of the principal, or remove it from the ACL if modes
+        is None."""
+
+        acl = self.meetings[name][1]
+        if modes is None:
+            acl.pop(principal, None)
+        else:
+            acl[principal] = modes
+
+    def get_transaction(self, name, number):
+        trn = self.meetings[name][2].get(number)
+        return dict(trn) if trn else None
+
+    def put_transaction(self, name, trn):
+        self.meetings[name][2][trn['number']] = dict(trn)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meetings (
+    name TEXT PRIMARY KEY,
+    long_name TEXT NOT NULL,
+    chairman TEXT NOT NULL,
+    public INTEGER NOT NULL,
+    date_created INTEGER NOT NULL,
+    date_modified INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    lowest INTEGER NOT NULL,
+    highest INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS acl (
+    name TEXT NOT NULL,
+    principal TEXT NOT NULL,
+    modes TEXT NOT NULL,
+    UNIQUE (name, principal)
+);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    name TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    pref INTEGER NOT NULL,
+    nref INTEGER NOT NULL,
+    fref INTEGER NOT NULL,
+    lref INTEGER NOT NULL,
+    chain_index INTEGER NOT NULL,
+    date_entered INTEGER NOT NULL,
+    num_lines INTEGER NOT NULL,
+    num_chars INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    author TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    flags INTEGER NOT NULL,
+    deleted INTEGER NOT NULL,
+    text BLOB NOT NULL,
+    PRIMARY KEY (name, number)
+) WITHOUT ROWID;
+"""
+
+_MEETING_FIELDS = ("long_name", "chairman", "public", "date_created", "date_modified",
+                   "first", "last", "lowest", "highest")
+_TRANSACTION_FIELDS = ("number", "pref", "nref", "fref", "lref", "chain_index",
+                       "date_entered", "num_lines", "num_chars", "subject", "author",
+                       "signature", "flags", "deleted", "text")
+
+class SQLiteMeetingStore(object):
+    """Meetings kept in an SQLite database. The changes are committed after
+    every batch of requests the server has handled."""
+
+    def __init__(self, location):
+        self.location = location
+        directory = os.path.dirname(self.location)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.db = sqlite3.connect(self.location, check_same_thread = False)
+        self.db.executescript(_SCHEMA)
+
+    def get_meeting(self, name):
+        row = self.db.execute("SELECT %s FROM meetings WHERE name = ?" % ", ".join(_MEETING_FIELDS),
+                (name,)).fetchone()
+        if row is None:
+            return None
+        info = dict(zip(_MEETING_FIELDS, row))
+        info['public'] = bool(info['public'])
+        return info
+
+    def put_meeting(self, name, info):
+        current = self.get_meeting(name) or {}
+        current.update(info)
+        self.db.execute("INSERT OR REPLACE INTO meetings VALUES (?, %s)" % ", ".join("?" * len(_MEETING_FIELDS)),
+                [name] + [current[field] for field in _MEETING_FIELDS])
+
+    def remove_meeting(self, name):
+        for table in ("transactions", "acl", "meetings"):
+            self.db.execute("DELETE FROM %s WHERE name = ?" % table, (name,))
+
+    def meeting_names(self):
+        return [name for name, in self.db.execute("SELECT name FROM meetings ORDER BY name")]
+
+    def get_acl(self, name):
+        return self.db.execute("SELECT principal, modes FROM acl WHERE name = ? ORDER BY rowid",
+                (name,)).fetchall()
+
+    def set_access(self, name, principal, modes):
+        """Set the modes of the principal, or remove it from the ACL if modes
+        is None."""
+
+        if modes is None:
+            self.db.execute("DELETE FROM acl WHERE name = ? AND principal = ?", (name, principal))
+            return
+
+        # Updated in place, so that the entry keeps its position in the list
+        cursor = self.db.execute("UPDATE acl SET modes = ? WHERE name = ? AND principal = ?",
+                (modes, name, principal))
+        if cursor.rowcount == 0:
+            self.db.execute("INSERT INTO acl VALUES (?, ?, ?)", (name, principal, modes))
+
+    def get_transaction(self, name, number):
+        row = self.db.execute("SELECT %s FROM transactions WHERE name = ? AND number = ?" %
+                ", ".join(_TRANSACTION_FIELDS), (name, number)).fetchone()
+        if row is None:
+            return None
+        trn = dict(zip(_TRANSACTION_FIELDS, row))
+        trn['deleted'] = bool(trn['deleted'])
+        trn['text'] = bytes(trn['text'])
+        return trn
+
+    def put_transaction(self, name, trn):
+        values = [trn[field] for field in _TRANSACTION_FIELDS]
+        values[-1] = sqlite3.Binary(values[-1])
+        self.db.execute("INSERT OR REPLACE INTO transactions VALUES (?, %s)" %
+                ", ".join("?" * len(_TRANSACTION_FIELDS)), [name] + values)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class DiscussServer(object):
+    """Stand-in discuss server. The meetings are referred to by their full
+    names, as the clients send them. The methods raise DiscussError, as the
+    real server would reply with the error code."""
+
+    def __init__(self, store = None, principal = "discuss@LOCALHOST", latency = 0, bandwidth = None):
+        self.store = store if store is not None else MemoryMeetingStore()
+        self.principal = principal
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.lock = threading.RLock()
+        self.listener = None
+        self.connections = set()
+
+    #
+    # Meetings
+    #
+
+    def _meeting(self, name):
+        info = self.store.get_meeting(name)
+        if info is None:
+            raise DiscussError(constants.NO_SUCH_MTG)
+        return info
+
+    def create_meeting(self, name, long_name = "", public = True, chairman = None):
+        """Create an empty meeting. The chairman (by default, the principal
+        of the server) gets all the access."""
+
+        with self.lock:
+            if not name.startswith("/"):
+                raise DiscussError(constants.BAD_PATH)
+            if self.store.get_meeting(name) is not None:
+                raise DiscussError(constants.DUP_MTG_NAME)
+
+            chairman = chairman or self.principal
+            now = int(time.time())
+            self.store.put_meeting(name, {
+                'long_name' : long_name,
+                'chairman' : chairman,
+                'public' : bool(public),
+                'date_created' : now,
+                'date_modified' : now,
+                'first' : 0,
+                'last' : 0,
+                'lowest' : 0,
+                'highest' : 0,
+            })
+            self.store.set_access(name, chairman, CHAIRMAN_MODES)
+            if public:
+                self.store.set_access(name, "*", PUBLIC_MODES)
+            self.store.commit()
+
+    def remove_meeting(self, name):
+        with self.lock:
+            self._meeting(name)
+            self.store.remove_meeting(name)
+
+    def meeting_info(self, name):
+        """Returns the dictionary of the meeting properties, as they are sent
+        in the GET_MTG_INFO reply (without the access modes)."""
+
+        with self.lock:
+            info = self._meeting(name)
+            info['location'] = name
+            return info
+
+    #
+    # Transactions
+    #
+
+    def _transaction(self, name, number, deleted = False):
+        """Returns the transaction, which has to exist, and unless deleted is
+        set, must not be deleted."""
+
+        trn = self.store.get_transaction(name, number) if number > 0 else None
+        if trn is None:
+            self._meeting(name)
+            raise DiscussError(constants.NO_SUCH_TRN)
+        if trn['deleted'] and not deleted:
+            raise DiscussError(constants.DELETED_TRN)
+        return trn
+
+    def _neighbour(self, name, number, step, limit):
+        """Returns the closest transaction which is not deleted in the given
+        direction, or 0."""
+
+        number += step
+        while 0 < number and (number <= limit if step > 0 else number >= limit):
+            trn = self.store.get_transaction(name, number)
+            if trn is not None and not trn['deleted']:
+                return number
+            number += step
+        return 0
+
+    def add_transaction(self, name, text, subject, reply_to = 0, signature = "", author = None, date = None):
+        """Post a transaction, possibly as a reply to another one, in which
+        case it is appended to the chain of that one. Returns the number of
+        the new transaction."""
+
+        if not isinstance(text, bytes):
+            text = text.encode()
+
+        with self.lock:
+            info = self._meeting(name)
+            number = info['highest'] + 1
+            trn = _new_transaction(number, bytes(text), subject, author or self.principal,
+                    signature, int(time.time()) if date is None else int(date))
+
+            if reply_to:
+                # The reply goes to the end of the chain
+                parent = self._transaction(name, reply_to)
+                first = self.store.get_transaction(name, parent['fref'])
+                last = self.store.get_transaction(name, first['lref'])
+                trn['pref'] = last['number']
+                trn['fref'] = first['number']
+                trn['chain_index'] = last['chain_index'] + 1
+
+                last['nref'] = number
+                self.store.put_transaction(name, last)
+                first = self.store.get_transaction(name, first['number'])
+                first['lref'] = number
+                self.store.put_transaction(name, first)
+
+            self.store.put_transaction(name, trn)
+
+            info['highest'] = info['last'] = number
+            info['lowest'] = info['lowest'] or number
+            info['first'] = info['first'] or number
+            info['date_modified'] = trn['date_entered']
+            self.store.put_meeting(name, info)
+            return number
+
+    def transaction_info(self, name, number):
+        """Returns the dictionary of header fields of the transaction, as they
+        are sent in the GET_TRN_INFO3 reply."""
+
+        with self.lock:
+            info = self._meeting(name)
+            trn = self._transaction(name, number)
+            first = self.store.get_transaction(name, trn['fref'])
+            trn['current'] = number
+            trn['prev'] = self._neighbour(name, number, -1, info['lowest'])
+            trn['next'] = self._neighbour(name, number, 1, info['highest'])
+            trn['lref'] = first['lref'] if first else number
+            return trn
+
+    def transaction_text(self, name, number):
+        with self.lock:
+            return self._transaction(name, number)['text']
+
+    def delete_transaction(self, name, number):
+        with self.lock:
+            info = self._meeting(name)
+            trn = self._transaction(name, number)
+            trn['deleted'] = True
+            self.store.put_transaction(name, trn)
+            self._update_range(name, info)
+
+    def retrieve_transaction(self, name, number):
+        with self.lock:
+            info = self._meeting(name)
+            trn = self._transaction(name, number, deleted = True)
+            if not trn['deleted']:
+                raise DiscussError(constants.TRN_NOT_DELETED)
+            trn['deleted'] = False
+            self.store.put_transaction(name, trn)
+            self._update_range(name, info)
+
+    def _update_range(self, name, info):
+        # The first and the last transactions skip over the deleted ones
+        info['first'] = self._neighbour(name, info['lowest'] - 1, 1, info['highest'])
+        info['last'] = self._neighbour(name, info['highest'] + 1, -1, info['lowest'])
+        # Clients notice deletions through the modification date, so it has
+        # to move even if the meeting was already changed within this second
+        info['date_modified'] = max(int(time.time()), info['date_modified'] + 1)
+        self.store.put_meeting(name, info)
+
+    def set_flags(self, name, number, flags):
+        with self.lock:
+            trn = self._transaction(name, number)
+            trn['flags'] = flags
+            self.store.put_transaction(name, trn)
+
+    #
+    # Access control
+    #
+
+    def get_acl(self, name):
+        """Returns the list of (principal, modes) pairs."""
+
+        with self.lock:
+            self._meeting(name)
+            return self.store.get_acl(name)
+
+    def get_access(self, name, principal):
+        """Returns the modes of the principal, or of everyone ("*") if it is
+        not on the list."""
+
+        acl = dict(self.get_acl(name))
+        return acl.get(principal, acl.get("*", ""))
+
+    def set_access(self, name, principal, modes):
+        with self.lock:
+            self._meeting(name)
+            if any(mode not in ACCESS_MODES for mode in modes):
+                raise DiscussError(constants.BAD_MODES)
+            self.store.set_access(name, principal, modes)
+
+    def delete_access(self, name, principal):
+        with self.lock:
+            info = self._meeting(name)
+            if principal not in dict(self.store.get_acl(name)):
+                raise DiscussError(constants.NO_PRINC)
+            if principal == info['chairman']:
+                raise DiscussError(constants.YOU_TWIT)
+            self.store.set_access(name, principal, None)
+
+    #
+    # Serving
+    #
+
+    def connect(self):
+        """Returns a socket connected to a new connection of the server, as
+        spawn_local_server() does with a disserve binary."""
+
+        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._serve(pair[1])
+        return pair[0]
+
+    def client_class(self, base = None):
+        """Returns the RPC client class whose connections go to this server,
+        to be passed to Client() as RPCClient. The server name given to the
+        client is only used to identify the meetings."""
+
+        return type("ServerRPCClient", (base or ServerRPCClient,), { 'backend' : self })
+
+    def listen(self, host = "127.0.0.1", port = 0):
+        """Start accepting connections on a TCP port. Returns the port."""
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+
+        thread = threading.Thread(target = self._accept, args = (self.listener,))
+        thread.daemon = True
+        thread.start()
+        return self.listener.getsockname()[1]
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except socket.error:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._serve(sock)
+
+    def _serve(self, sock):
+        connection = ServerConnection(self, sock)
+        with self.lock:
+            self.connections.add(connection)
+
+        thread = threading.Thread(target = connection.serve)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stop listening and drop all the connections."""
+
+        if self.listener is not None:
+            # Closing the socket alone does not wake up accept()
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.listener.close()
+            self.listener = None
+
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+        self.store.close()
+
+    #
+    # Procedures
+    #
+
+    def handle(self, connection, request):
+        """Handle one request. Returns the list of blocks sent in reply."""
+
+        procedure = request.block_type - constants.PROC_BASE
+        handler = _HANDLERS.get(procedure)
+        if handler is None:
+            return [USPBlock(constants.UNKNOWN_CALL)]
+        return handler(self, connection, request)
+
+def _reply(record, *values):
+    block = USPBlock(constants.REPLY_TYPE)
+    record.pack(block, *values)
+    return block
+
+def _result(f, *args):
+    """Calls the function and returns the RESULT reply with the error code."""
+
+    try:
+        f(*args)
+        return [_reply(records.RESULT, 0)]
+    except DiscussError as err:
+        return [_reply(records.RESULT, err.code)]
+
+def _get_server_version(server, connection, request):
+    return [_reply(records.SERVER_VERSION_REPLY, constants.SERVER_2)]
+
+def _who_am_i(server, connection, request):
+    return [_reply(records.WHO_AM_I_REPLY, connection.principal)]
+
+def _create_mtg(server, connection, request):
+    location, long_name, public = records.CREATE_MTG_REQUEST.unpack(request)
+    return _result(server.create_meeting, location, long_name, public, connection.principal)
+
+def _remove_mtg(server, connection, request):
+    name, = records.MTG_NAME.unpack(request)
+    return _result(server.remove_meeting, name)
+
+def _get_mtg_info(server, connection, request):
+    name, = records.MTG_NAME.unpack(request)
+    try:
+        info = server.meeting_info(name)
+        modes = server.get_access(name, connection.principal)
+    except DiscussError as err:
+        return [_reply(records.MTG_INFO_REPLY, 0, "", "", "", 0, 0, 0, 0, 0, 0, False, "", err.code)]
+
+    return [_reply(records.MTG_INFO_REPLY, 0, name, info['long_name'], info['chairman'],
+            info['first'], info['last'], info['lowest'], info['highest'],
+            info['date_created'], info['date_modified'], info['public'], modes, 0)]
+
+def _updated_mtg(server, connection, request):
+    name, date_attended, last = records.UPDATED_MTG_REQUEST.unpack(request)
+    try:
+        info = server.meeting_info(name)
+    except DiscussError as err:
+        return [_reply(records.UPDATED_MTG_REPLY, False, err.code)]
+
+    if last > info['highest']:
+        return [_reply(records.UPDATED_MTG_REPLY, False, constants.NO_SUCH_TRN)]
+    return [_reply(records.UPDATED_MTG_REPLY, last < info['last'], 0)]
+
+def _get_trn_info3(server, connection, request):
+    name, number = records.TRN_NUMBER.unpack(request)
+    try:
+        trn = server.transaction_info(name, number)
+    except DiscussError as err:
+        return [_reply(records.TRN_INFO_REPLY, 0, number, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                "", "", 0, "", err.code)]
+
+    return [_reply(records.TRN_INFO_REPLY, 0, number, trn['prev'], trn['next'],
+            trn['pref'], trn['nref'], trn['fref'], trn['lref'], trn['chain_index'],
+            trn['date_entered'], trn['num_lines'], trn['num_chars'], trn['subject'],
+            trn['author'], trn['flags'], trn['signature'], 0)]
+
+def _get_trn(server, connection, request):
+    name, number, tfile = records.GET_TRN_REQUEST.unpack(request)
+    try:
+        text = server.transaction_text(name, number)
+    except DiscussError as err:
+        # No text is sent with an error
+        return [_reply(records.RESULT, err.code)]
+
+    block = USPBlock(constants.TFILE_BLK)
+    block.buffer = text
+    return [block, _reply(records.RESULT, 0)]
+
+def _add_trn(server, connection, request):
+    if request.block_type - constants.PROC_BASE == constants.ADD_TRN2:
+        name, length, subject, signature, reply_to = records.ADD_TRN2_REQUEST.unpack(request)
+    else:
+        name, length, subject, reply_to = records.ADD_TRN_REQUEST.unpack(request)
+        signature = ""
+
+    # The text follows in a separate block
+    tfile = connection.receive()
+    if tfile.block_type != constants.TFILE_BLK:
+        raise ProtocolError("Expected the text of the transaction")
+
+    try:
+        number = server.add_transaction(name, bytes(tfile.buffer[:length]), subject,
+                reply_to, signature, connection.principal)
+    except DiscussError as err:
+        return [_reply(records.ADD_TRN_REPLY, 0, err.code)]
+    return [_reply(records.ADD_TRN_REPLY, number, 0)]
+
+def _delete_trn(server, connection, request):
+    name, number = records.TRN_NUMBER.unpack(request)
+    return _result(server.delete_transaction, name, number)
+
+def _retrieve_trn(server, connection, request):
+    name, number = records.TRN_NUMBER.unpack(request)
+    return _result(server.retrieve_transaction, name, number)
+
+def _set_trn_flags(server, connection, request):
+    name, number, flags = records.SET_TRN_FLAGS_REQUEST.unpack(request)
+    return _result(server.set_flags, name, number, flags)
+
+def _get_acl(server, connection, request):
+    name, = records.MTG_NAME.unpack(request)
+    try:
+        acl = server.get_acl(name)
+    except DiscussError as err:
+        return [_reply(records.ACL_REPLY, err.code, 0)]
+
+    reply = _reply(records.ACL_REPLY, 0, len(acl))
+    for principal, modes in acl:
+        records.ACL_ENTRY.pack(reply, modes, principal)
+    return [reply]
+
+def _get_access(server, connection, request):
+    name, principal = records.GET_ACCESS_REQUEST.unpack(request)
+    try:
+        modes = server.get_access(name, principal)
+    except DiscussError as err:
+        return [_reply(records.GET_ACCESS_REPLY, "", err.code)]
+    return [_reply(records.GET_ACCESS_REPLY, modes, 0)]
+
+def _set_access(server, connection, request):
+    name, principal, modes = records.SET_ACCESS_REQUEST.unpack(request)
+    return _result(server.set_access, name, principal, modes)
+
+def _delete_access(server, connection, request):
+    # Same arguments as GET_ACCESS
+    name, principal = records.GET_ACCESS_REQUEST.unpack(request)
+    return _result(server.delete_access, name, principal)
+
+_HANDLERS = {
+    constants.ADD_TRN : _add_trn,
+    constants.DELETE_TRN : _delete_trn,
+    constants.RETRIEVE_TRN : _retrieve_trn,
+    constants.CREATE_MTG : _create_mtg,
+    constants.GET_TRN : _get_trn,
+    constants.REMOVE_MTG : _remove_mtg,
+    constants.UPDATED_MTG : _updated_mtg,
+    constants.GET_MTG_INFO : _get_mtg_info,
+    constants.GET_ACL : _get_acl,
+    constants.GET_ACCESS : _get_access,
+    constants.SET_ACCESS : _set_access,
+    constants.DELETE_ACCESS : _delete_access,
+    constants.WHO_AM_I : _who_am_i,
+    constants.GET_SERVER_VERSION : _get_server_version,
+    constants.SET_TRN_FLAGS : _set_trn_flags,
+    constants.ADD_TRN2 : _add_trn,
+    constants.GET_TRN_INFO3 : _get_trn_info3,
+}
+
+class ServerConnection(object):
+    """One client connection of the stand-in server."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+        self.reader = USPReader()
+        self.principal = server.principal
+
+        # Replies to the requests read so far, and when the first of them was
+        # produced
+        self.replies = []
+        self.replied = None
+
+        # With the latency or the bandwidth limited, the replies are written
+        # by a separate thread, as (time due, data) pairs
+        self.delayed = bool(server.latency or server.bandwidth)
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        if self.delayed:
+            thread = threading.Thread(target = self._write_delayed)
+            thread.daemon = True
+            thread.start()
+
+    def receive(self):
+        """Returns the next request block. Before waiting for more data, the
+        replies to everything read so far are sent."""
+
+        block = self.reader.next_block()
+        while block is None:
+            self.flush()
+            self.reader.fill(self.socket)
+            block = self.reader.next_block()
+        return block
+
+    def serve(self):
+        try:
+            block = self.receive()
+            # TCP clients open with the authenticator, which is taken on
+            # trust; the local ones do not send it
+            if block.block_type != constants.KRB_TICKET:
+                self.reply(self.server.handle(self, block))
+
+            while True:
+                self.reply(self.server.handle(self, self.receive()))
+        except (ProtocolError, socket.error, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def reply(self, blocks):
+        if self.replied is None:
+            self.replied = time.time()
+        for block in blocks:
+            self.replies.extend(block.encode())
+
+    def flush(self):
+        with self.server.lock:
+            self.server.store.commit()
+        if not self.replies:
+            return
+
+        data = b"".join(self.replies)
+        due = self.replied + self.server.latency
+        self.replies = []
+        self.replied = None
+
+        if not self.delayed:
+            self.socket.sendall(data)
+            return
+        with self.condition:
+            self.pending.append((due, data))
+            self.condition.notify()
+
+    def _write_delayed(self):
+        # Time when the link is done with what has been sent before
+        free = 0
+        bandwidth = self.server.bandwidth
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                due, data = self.pending.popleft()
+
+            for offset in range(0, len(data), _THROTTLE_CHUNK if bandwidth else len(data)):
+                chunk = data[offset:offset + _THROTTLE_CHUNK] if bandwidth else data
+                delivered = max(due, free)
+                if bandwidth:
+                    delivered += float(len(chunk)) / bandwidth
+                wait = delivered - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    self.socket.sendall(chunk)
+                except socket.error:
+                    return
+                free = delivered
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        with self.server.lock:
+            self.server.connections.discard(self)
+
+class ServerRPCClient(RPCClient):
+    """RPC client connected to a DiscussServer in the same process. Use
+    DiscussServer.client_class() to get one bound to a server."""
+
+    # The DiscussServer the connections go to
+    backend = None
+
+    # Args are for compatibility with the remote RPC; most aren't used
+    def __init__(self, server, port = 2100, auth = False, timeout = None):
+        # Used as the id field on meeting objects, so copy it in
+        self.server = server
+        self.port = port
+        self.auth = auth
+        self.timeout = timeout
+
+        self.make_wrapper()
+        self.connect()
+
+    def connect(self):
+        self.socket = self.backend.connect()
+        self.socket.settimeout(self.timeout)
+        self.reset_state()
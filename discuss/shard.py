@@ -0,0 +1,216 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the download of a single large meeting over
+# several connections at once. A pipelined connection is limited by a single
+# TCP stream and by the thread which decodes its replies; here the range of
+# transactions is cut into chunks, and each of the shards (a connection with
+# a thread of its own) takes the next chunk as soon as it has finished the
+# previous one. The chunks are put back together in the order of transaction
+# numbers.
+#
+# The shards may run ahead of the consumer only by a limited number of
+# chunks, so streaming a huge meeting does not keep all of it in memory. If
+# a connection fails, the shard reconnects and fetches the rest of its chunk
+# again; the other shards are not affected.
+#
+# Example:
+#
+#     mtg = Meeting(cl, "/var/spool/discuss/vasilvv-test")
+#     for trn, text in ShardedDownload(mtg, shards = 8, texts = True):
+#         print(trn.number, trn.subject)
+#
+
+import socket
+import threading
+
+from .client import Client, Meeting
+from .rpc import ProtocolError
+
+class ShardError(Exception):
+    """Raised when a chunk could not be fetched after all the retries."""
+
+    def __init__(self, start, end, error):
+        Exception.__init__(self, "Failed to fetch transactions %i-%i: %s" % (start, end, error))
+        self.start = start
+        self.end = end
+        self.error = error
+
+def _default_client(rpc):
+    return Client(rpc.server, rpc.port, rpc.auth, rpc.timeout, RPCClient = type(rpc))
+
+class ShardedDownload(object):
+    """Iterable over the transactions of the meeting (or (transaction, text)
+    pairs, if texts is set) in the given range, fetched over the given
+    number of connections in parallel. Without start and end, covers the
+    whole meeting.
+
+    The range is split into chunks of chunk_size transactions. Every shard
+    opens its own connection to the server of the meeting, using
+    make_client(rpc) (by default, a Client with the same parameters as the
+    meeting's connection), and fetches one chunk at a time with the requests
+    pipelined (see Meeting.iter_transactions() for window). At most
+    max_ahead chunks are fetched ahead of the one the caller is reading.
+
+    A chunk which fails because of a connection problem is resumed on a new
+    connection up to retries times; after that, ShardError is raised when
+    the iteration reaches that chunk. Discuss errors are not retried.
+
+    The transactions are bound to the given meeting, so their methods use
+    the meeting's own connection. The store of the meeting is not used."""
+
+    def __init__(self, meeting, start = 1, end = -1, shards = 4, texts = False,
+                 chunk_size = 1000, max_ahead = None, retries = 3, window = None,
+                 make_client = None, feedback = None):
+        self.meeting = meeting
+        self.start = start
+        self.end = end
+        self.shards = shards
+        self.texts = texts
+        self.chunk_size = chunk_size
+        self.max_ahead = max_ahead if max_ahead is not None else 2 * shards
+        self.retries = retries
+        self.window = window
+        self.make_client = make_client or _default_client
+        self.feedback = feedback
+
+    def __iter__(self):
+        meeting = self.meeting
+        start, end = self.start, self.end
+        if end == -1:
+            meeting.load_info()
+            end = meeting.last
+
+        self.chunks = [ (first, min(first + self.chunk_size - 1, end))
+                for first in range(start, end + 1, self.chunk_size) ]
+        self.results = {}           # chunk index -> list of items, or exception
+        self.next_chunk = 0         # Next chunk to be taken by a shard
+        self.consumed = 0           # Number of chunks passed to the caller
+        self.stopped = False
+        self.condition = threading.Condition()
+
+        threads = []
+        for i in range(min(self.shards, len(self.chunks))):
+            thread = threading.Thread(target = self._run_shard)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for index in range(len(self.chunks)):
+                with self.condition:
+                    while index not in self.results:
+                        self.condition.wait()
+                    items = self.results.pop(index)
+                    self.consumed += 1
+                    self.condition.notify_all()
+
+                if isinstance(items, Exception):
+                    raise items
+                for item in items:
+                    if self.feedback:
+                        number = item[0].number if self.texts else item.number
+                        self.feedback(cur = number, total = end - start + 1, left = end - number + 1)
+                    yield item
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+            for thread in threads:
+                thread.join()
+
+    def collect(self):
+        """Fetch the whole range and return it as a list."""
+
+        return list(self)
+
+    def _take_chunk(self):
+        """Returns the index of the next chunk to fetch, or None if there is
+        nothing left to do."""
+
+        with self.condition:
+            while not self.stopped and self.next_chunk < len(self.chunks) and \
+                    self.next_chunk - self.consumed >= self.max_ahead:
+                self.condition.wait()
+            if self.stopped or self.next_chunk >= len(self.chunks):
+                return None
+            index = self.next_chunk
+            self.next_chunk += 1
+            return index
+
+    def _run_shard(self):
+        client = None
+        try:
+            while True:
+                index = self._take_chunk()
+                if index is None:
+                    return
+
+                items = []
+                start, end = self.chunks[index]
+                failures = 0
+                while True:
+                    try:
+                        if client is None:
+                            client = self.make_client(self.meeting.rpc)
+                        if not self._fetch(client, start, end, items):
+                            # Stopped and dropped the connection
+                            client = None
+                        break
+                    except (ProtocolError, socket.error) as err:
+                        # Resume the chunk after the last transaction received
+                        if client is not None:
+                            client.close(reusable = False)
+                            client = None
+                        failures += 1
+                        if failures > self.retries:
+                            items = ShardError(self.chunks[index][0], end, err)
+                            break
+                        if items:
+                            trn = items[-1][0] if self.texts else items[-1]
+                            start = trn.number + 1
+                    except Exception as err:
+                        if client is not None:
+                            client.close(reusable = False)
+                            client = None
+                        items = err
+                        break
+
+                with self.condition:
+                    self.results[index] = items
+                    self.condition.notify_all()
+        finally:
+            if client is not None:
+                client.close()
+
+    def _fetch(self, client, start, end, items):
+        """Fetch the range over the client's connection, appending the items
+        to the list as they arrive. If the download is stopped meanwhile,
+        the client is closed, and False is returned."""
+
+        shard_meeting = Meeting(client, self.meeting.name)
+        if self.texts:
+            source = shard_meeting.get_texts(start, end, window = self.window)
+        else:
+            source = shard_meeting.iter_transactions(start, end, window = self.window)
+
+        try:
+            for item in source:
+                if self.stopped:
+                    # The replies in flight are not worth reading, and the
+                    # connection is not going to be used again
+                    client.close(reusable = False)
+                    return False
+                trn = item[0] if self.texts else item
+                trn.meeting = self.meeting
+                items.append(item)
+        finally:
+            source.close()
+        return True
+
+def sharded_transactions(meeting, start = 1, end = -1, shards = 4, **kwargs):
+    """Returns the list of transactions in the range, fetched over several
+    connections. See ShardedDownload for the other arguments."""
+
+    return ShardedDownload(meeting, start, end, shards, **kwargs).collect()
@@ -0,0 +1,203 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements the local store of transaction headers and
+# texts. A Meeting created with a store reads through it: the headers and
+# texts which are already stored are not requested from the server again.
+#
+# The store is validated against the meeting information (last, highest and
+# the modification date) every time a range of transactions is read. If new
+# transactions were posted and nothing else happened (the modification date
+# is the date of the newest transaction), only the new headers are fetched,
+# together with the old headers whose pointers they changed: the previous
+# last transaction and the ends of the chains they were appended to. Any
+# other change drops all the stored headers of the meeting, which are then
+# fetched again on demand. The texts are kept, since the text of a
+# transaction never changes. If the meeting was recreated (its highest
+# transaction went down), everything is dropped.
+#
+# A deletion which is followed by new transactions before the store is
+# validated again cannot be told apart from the new transactions alone, so
+# its header stays until the meeting changes otherwise, or until the text of
+# the transaction is requested and the server reports it deleted.
+#
+
+import sqlite3
+import threading
+
+from . import records
+from .rcfile import locate_cache_file, _make_parent_directory
+
+# Header fields in the order of GET_TRN_INFO3 reply; "current" is the number
+HEADER_FIELDS = tuple(name for name in records.TRN_INFO_REPLY.names
+        if name not in ("current", "result"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meetings (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    last INTEGER NOT NULL,
+    highest INTEGER NOT NULL,
+    date_modified TEXT NOT NULL,
+    PRIMARY KEY (host, path)
+);
+
+CREATE TABLE IF NOT EXISTS headers (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    deleted INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (host, path, number)
+);
+
+CREATE TABLE IF NOT EXISTS texts (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (host, path, number)
+);
+""" % ",\n    ".join(name + (" TEXT" if kind == "string" else " INTEGER")
+        for name, kind in records.TRN_INFO_REPLY.fields
+        if name in HEADER_FIELDS)
+
+class TransactionStore(object):
+    """SQLite database of transaction headers and texts, keyed by the meeting
+    id (a (host, path) tuple)."""
+
+    def __init__(self, location = None):
+        self.location = location or locate_cache_file("transactions.sqlite3")
+        _make_parent_directory(self.location)
+
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.location, check_same_thread = False)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_state(self, mtg_id):
+        """Returns the (last, highest, date_modified) of the meeting at the
+        time it was last validated, or None."""
+
+        with self.lock:
+            row = self.db.execute("SELECT last, highest, date_modified FROM meetings "
+                    "WHERE host = ? AND path = ?", mtg_id).fetchone()
+        return tuple(row) if row else None
+
+    def set_state(self, mtg_id, last, highest, date_modified):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meetings VALUES (?, ?, ?, ?, ?)",
+                    mtg_id + (last, highest, date_modified))
+
+    def put_headers(self, mtg_id, headers, deleted = ()):
+        """Store the headers (dictionaries of header fields) and mark the
+        numbers in deleted as deleted transactions."""
+
+        columns = ("number", "deleted") + HEADER_FIELDS
+        statement = "INSERT OR REPLACE INTO headers (host, path, %s) VALUES (%s)" % (
+                ", ".join(columns), ", ".join("?" * (len(columns) + 2)))
+
+        rows = [ mtg_id + (info['current'], 0) + tuple(info[name] for name in HEADER_FIELDS)
+                for info in headers ]
+        rows += [ mtg_id + (number, 1) + (None,) * len(HEADER_FIELDS)
+                for number in deleted ]
+
+        with self.lock, self.db:
+            self.db.executemany(statement, rows)
+
+    def _make_info(self, row):
+        info = dict(zip(HEADER_FIELDS, row[1:]))
+        info['current'] = row[0]
+        return info
+
+    def get_header(self, mtg_id, number):
+        """Returns the header of the transaction, False if the transaction is
+        known to be deleted, or None if it is not stored."""
+
+        with self.lock:
+            row = self.db.execute("SELECT deleted, number, %s FROM headers "
+                    "WHERE host = ? AND path = ? AND number = ?" % ", ".join(HEADER_FIELDS),
+                    mtg_id + (number,)).fetchone()
+
+        if row is None:
+            return None
+        if row[0]:
+            return False
+        return self._make_info(row[1:])
+
+    def headers(self, mtg_id, start, end, batch = 1000):
+        """Iterate over the stored headers of the existing transactions in the
+        given range, in order. The rows are read batch at a time."""
+
+        statement = ("SELECT number, %s FROM headers "
+                "WHERE host = ? AND path = ? AND number BETWEEN ? AND ? AND deleted = 0 "
+                "ORDER BY number LIMIT ?" % ", ".join(HEADER_FIELDS))
+        while start <= end:
+            with self.lock:
+                rows = self.db.execute(statement, mtg_id + (start, end, batch)).fetchall()
+            if not rows:
+                return
+
+            for row in rows:
+                yield self._make_info(row)
+            start = rows[-1][0] + 1
+
+    def missing_headers(self, mtg_id, start, end):
+        """Returns the list of numbers in the range which are not stored."""
+
+        with self.lock:
+            stored = set(number for number, in self.db.execute("SELECT number FROM headers "
+                    "WHERE host = ? AND path = ? AND number BETWEEN ? AND ?",
+                    mtg_id + (start, end)))
+        return [number for number in range(start, end + 1) if number not in stored]
+
+    def extend_chain(self, mtg_id, first, old_last, new_last):
+        """Point the stored transactions of the chain starting at first,
+        which ended at old_last, to its new last transaction."""
+
+        with self.lock, self.db:
+            self.db.execute("UPDATE headers SET lref = ? WHERE host = ? AND path = ? "
+                    "AND fref = ? AND lref = ? AND deleted = 0",
+                    (new_last,) + mtg_id + (first, old_last))
+
+    def invalidate_headers(self, mtg_id):
+        """Drop all the stored headers of the meeting."""
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM headers WHERE host = ? AND path = ?", mtg_id)
+
+    def invalidate(self, mtg_id):
+        """Drop everything stored for the meeting."""
+
+        with self.lock, self.db:
+            for table in ("meetings", "headers", "texts"):
+                self.db.execute("DELETE FROM %s WHERE host = ? AND path = ?" % table, mtg_id)
+
+    def get_text(self, mtg_id, number):
+        with self.lock:
+            row = self.db.execute("SELECT text FROM texts WHERE host = ? AND path = ? AND number = ?",
+                    mtg_id + (number,)).fetchone()
+        return row[0] if row else None
+
+    def put_texts(self, mtg_id, texts):
+        """Store the texts given as (number, text) pairs."""
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?)",
+                    [mtg_id + (number, text) for number, text in texts])
+
+    def missing_texts(self, mtg_id, numbers):
+        """Returns the numbers from the list whose texts are not stored."""
+
+        numbers = list(numbers)
+        if not numbers:
+            return []
+
+        with self.lock:
+            stored = set(number for number, in self.db.execute("SELECT number FROM texts "
+                    "WHERE host = ? AND path = ? AND number BETWEEN ? AND ?",
+                    mtg_id + (min(numbers), max(numbers))))
+        return [number for number in numbers if number not in stored]
@@ -0,0 +1,242 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements incremental synchronization of meetings.
+# Every .meetings entry records the last transaction the user has seen;
+# UPDATED_MTG tells whether the meeting has anything after it, so only the
+# meetings which changed are read, and only from the recorded checkpoint on.
+#
+# Example:
+#
+#     def show(meeting, trn):
+#         print("%s [%i] %s" % (meeting.short_name, trn.number, trn.subject))
+#
+#     rc = RCFile()
+#     sync(rc, show)
+#
+
+from .client import Client, Meeting, DiscussError
+from .rcfile import RCFile
+from .rpc import USPBlock, ProtocolError
+from . import constants, records
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+class SyncResult(object):
+    """Outcome of synchronizing a single meeting."""
+
+    def __init__(self, mtg_id):
+        self.id = mtg_id
+        self.updated = False    # Whether the server reported new transactions
+        self.fetched = 0        # Number of transactions passed to the handler
+        self.last = None        # Checkpoint after the synchronization
+        self.error = None       # Exception which stopped the synchronization
+
+    def __repr__(self):
+        return "<SyncResult %s:%s updated=%s fetched=%i last=%s error=%r>" % (
+                self.id + (self.updated, self.fetched, self.last, self.error))
+
+def check_updates(client, checkpoints):
+    """Ask the server whether the meetings have anything after their
+    checkpoints. The UPDATED_MTG requests for all the meetings are pipelined
+    over the client's connection. Takes a list of (meeting name, last) pairs
+    and returns the list of results, where each result is either a boolean
+    or the DiscussError for that meeting."""
+
+    rpc = client.rpc
+    for name, last in checkpoints:
+        request = USPBlock(constants.PROC_BASE + constants.UPDATED_MTG)
+        records.UPDATED_MTG_REQUEST.pack(request, name, 0, last)
+        rpc.queue(request)
+
+    results = []
+    for name, last in checkpoints:
+        reply = rpc.receive()
+        if reply.block_type != constants.REPLY_TYPE:
+            raise ProtocolError("Transport-level error")
+        updated, code = records.UPDATED_MTG_REPLY.unpack(reply)
+        results.append(DiscussError(code) if code != 0 else bool(updated))
+
+    return results
+
+def sync_meeting(meeting, last, handler, texts = False, result = None, updated = None, batch = 1000):
+    """Pass every transaction after the last one to the handler, as
+    handler(meeting, transaction), or handler(meeting, transaction, text) if
+    texts is set. Returns the SyncResult; its last attribute is the number
+    of the last transaction handled (or the old checkpoint). If it is
+    already known whether the meeting was updated, it may be passed in.
+
+    The transactions are read batch at a time, and the handler is only
+    called once the whole batch has arrived, so it may use the connection
+    of the meeting (e.g. call trn.get_text()), although passing texts is
+    much faster than fetching the texts one by one."""
+
+    if result is None:
+        result = SyncResult(meeting.id)
+    result.last = last
+
+    if updated is None:
+        updated = meeting.check_update(last)
+    result.updated = updated
+    if not result.updated:
+        return result
+
+    meeting.load_info(force = True)
+    end = meeting.last
+    for first in range(last + 1, end + 1, batch):
+        batch_end = min(first + batch - 1, end)
+        if texts:
+            items = list(meeting.get_texts(first, batch_end))
+        else:
+            items = [(trn,) for trn in meeting.iter_transactions(first, batch_end)]
+
+        for item in items:
+            handler(meeting, *item)
+            result.fetched += 1
+            result.last = item[0].number
+
+    # Deleted transactions at the end are skipped, but they are still read
+    if end > result.last:
+        result.last = end
+
+    return result
+
+def _default_client(host, pool):
+    return Client(host, pool = pool)
+
+class SyncExecutor(object):
+    """Synchronizes many meetings at once.
+
+    The meetings are grouped by host. Each host gets at most per_host
+    connections, and the meetings of the host are split between them; on
+    every connection, the UPDATED_MTG checks for all of its meetings are
+    pipelined, and then the changed meetings are read one after another
+    with their transactions pipelined. Up to max_workers connections (to
+    all hosts together) are served in parallel by a thread pool.
+
+    The handler is called from the worker threads, so it has to be thread
+    safe if there is more than one worker."""
+
+    def __init__(self, max_workers = 8, per_host = 2, pool = None, make_client = None):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.pool = pool
+        self.make_client = make_client or _default_client
+
+    def run(self, source, handler, texts = False, save = True, feedback = None):
+        """Fetch the new transactions of the meetings in the source and pass
+        them to the handler (see sync_meeting()).
+
+        The source is either an RCFile, whose entries (except deleted ones)
+        are synchronized from their last_transaction, or a dictionary mapping
+        meeting ids to the checkpoints, which is updated in place. For an
+        RCFile, the checkpoints are updated with RCFile.touch() and, if save
+        is set, the file is saved atomically after each meeting.
+
+        The feedback function is called after each meeting as
+        feedback(cur = meeting id, total = number of meetings, left =
+        meetings still to go).
+
+        An error in one meeting, including one raised by the handler, does
+        not stop the others; it is reported in the error attribute of its
+        SyncResult, whose last attribute is still the checkpoint of the
+        transactions handled before it. Returns the list of
+        SyncResults, in the order of hosts and meetings."""
+
+        if isinstance(source, RCFile):
+            checkpoints = dict( (mtg_id, entry['last_transaction'])
+                    for mtg_id, entry in source.entries.items()
+                    if not entry['deleted'] )
+        else:
+            checkpoints = source
+
+        lock = threading.Lock()
+        progress = { 'left' : len(checkpoints) }
+
+        def on_result(result):
+            with lock:
+                progress['left'] -= 1
+                if result.last is not None and result.last != checkpoints[result.id]:
+                    if isinstance(source, RCFile):
+                        source.touch(result.id, result.last)
+                        if save:
+                            source.save()
+                    else:
+                        source[result.id] = result.last
+                if feedback:
+                    feedback(cur = result.id, total = len(checkpoints), left = progress['left'])
+
+        lanes = []
+        for host, mtg_ids in sorted(_group_by_host(checkpoints).items()):
+            count = max(1, min(self.per_host, len(mtg_ids)))
+            for i in range(count):
+                lanes.append((host, mtg_ids[i::count]))
+
+        run_lane = lambda lane: self._sync_lane(lane[0], lane[1], dict(checkpoints),
+                handler, texts, on_result)
+        if self.max_workers <= 1 or len(lanes) <= 1:
+            lane_results = [run_lane(lane) for lane in lanes]
+        else:
+            with ThreadPoolExecutor(max_workers = min(self.max_workers, len(lanes))) as executor:
+                lane_results = list(executor.map(run_lane, lanes))
+
+        # Put the results back in the order of the meetings
+        order = dict( (mtg_id, i) for i, mtg_id in enumerate(
+                mtg_id for host, mtg_ids in sorted(_group_by_host(checkpoints).items())
+                for mtg_id in mtg_ids) )
+        results = [result for results in lane_results for result in results]
+        results.sort(key = lambda result: order[result.id])
+        return results
+
+    def _sync_lane(self, host, mtg_ids, checkpoints, handler, texts, on_result):
+        """Synchronize the meetings on one host over a single connection."""
+
+        results = []
+        client = None
+        updates = {}
+        try:
+            for mtg_id in mtg_ids:
+                result = SyncResult(mtg_id)
+                try:
+                    if client is None:
+                        client = self.make_client(host, self.pool)
+                        remaining = mtg_ids[mtg_ids.index(mtg_id):]
+                        updates = dict(zip(remaining, check_updates(client,
+                                [(i[1], checkpoints[i]) for i in remaining])))
+
+                    updated = updates.get(mtg_id)
+                    if isinstance(updated, Exception):
+                        raise updated
+                    meeting = Meeting(client, mtg_id[1])
+                    sync_meeting(meeting, checkpoints[mtg_id], handler, texts, result, updated)
+                except Exception as err:
+                    # The handler may raise anything; the meeting still gets
+                    # its result, with the checkpoint of what was handled
+                    result.error = err
+                    if result.last is None:
+                        result.last = checkpoints[mtg_id]
+                    if not isinstance(err, DiscussError) and client is not None:
+                        # The connection is in unknown state
+                        client.close(reusable = False)
+                        client = None
+                results.append(result)
+                on_result(result)
+        finally:
+            if client is not None:
+                client.close()
+
+        return results
+
+def _group_by_host(checkpoints):
+    hosts = {}
+    for mtg_id in sorted(checkpoints):
+        hosts.setdefault(mtg_id[0], []).append(mtg_id)
+    return hosts
+
+def sync(source, handler, texts = False, save = True, pool = None, make_client = None, feedback = None):
+    """Synchronize the meetings one after another, using one connection per
+    host. See SyncExecutor.run() for the arguments."""
+
+    executor = SyncExecutor(max_workers = 1, per_host = 1, pool = pool, make_client = make_client)
+    return executor.run(source, handler, texts, save, feedback)
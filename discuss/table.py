@@ -0,0 +1,136 @@
+#
+# Python client for Project Athena forum system.
+# See LICENSE file for more details.
+#
+# The following file implements a compact in-memory table of transaction
+# headers. Instead of an object per transaction, every header field is kept
+# in a column: the integer fields in arrays of machine integers, the subjects
+# in a list, and the authors and signatures, which repeat a lot, as indices
+# into a table of distinct strings. The dates stay timestamps until they are
+# looked at.
+#
+# Indexing the table gives an ordinary Transaction built from the row, so the
+# code written for the lists returned by Meeting.transactions() works with
+# the table as well.
+#
+# Example:
+#
+#     table = TransactionTable.fetch(mtg)
+#     print(len(table), table[-1].subject, table.get(1234).author)
+#
+
+from array import array
+from bisect import bisect_left
+
+from .client import Transaction
+from . import records
+
+# Integer header fields, in the order of the GET_TRN_INFO3 reply
+_INTEGER_FIELDS = tuple(name for name, kind in records.TRN_INFO_REPLY.fields
+        if kind != "string" and name != "result")
+
+# String fields which are stored as indices into the string table
+_INTERNED_FIELDS = ("author", "signature")
+
+class TransactionTable(object):
+    """Column-oriented list of the transaction headers of a meeting, in the
+    order of transaction numbers."""
+
+    def __init__(self, meeting):
+        self.meeting = meeting
+        self.columns = dict( (name, array('i')) for name in _INTEGER_FIELDS + _INTERNED_FIELDS )
+        self.subjects = []
+        self.strings = []       # Distinct authors and signatures
+        self.string_ids = {}    # String -> its index in strings
+
+    @classmethod
+    def fetch(cls, meeting, start = 1, end = -1, abandon = False, window = None):
+        """Retrieve the headers of the given range of transactions (all of
+        them by default) into a new table. See Meeting.iter_transactions()
+        for the arguments."""
+
+        table = cls(meeting)
+        table.extend(meeting.iter_headers(start, end, abandon, window))
+        return table
+
+    def _intern(self, string):
+        index = self.string_ids.get(string)
+        if index is None:
+            index = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def append(self, info):
+        """Add the header given as a dictionary of header fields (as returned
+        by Meeting.iter_headers()). The transactions have to be added in the
+        order of their numbers."""
+
+        numbers = self.columns['current']
+        if numbers and info['current'] <= numbers[-1]:
+            raise ValueError("Transaction %i added after %i" % (info['current'], numbers[-1]))
+
+        for name in _INTEGER_FIELDS:
+            self.columns[name].append(info[name])
+        for name in _INTERNED_FIELDS:
+            self.columns[name].append(self._intern(info[name]))
+        self.subjects.append(info['subject'])
+
+    def extend(self, infos):
+        for info in infos:
+            self.append(info)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getitem__(self, index):
+        """Returns the transaction at the given position (not the number) in
+        the table, or the list of them for a slice."""
+
+        if isinstance(index, slice):
+            return [self._make_transaction(i) for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Transaction table index out of range")
+        return self._make_transaction(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._make_transaction(index)
+
+    def _make_transaction(self, index):
+        columns = self.columns
+        trn = Transaction(self.meeting, columns['current'][index])
+        for name in _INTEGER_FIELDS:
+            setattr(trn, name, columns[name][index])
+        for name in _INTERNED_FIELDS:
+            setattr(trn, name, self.strings[columns[name][index]])
+        trn.subject = self.subjects[index]
+        return trn
+
+    def find(self, number):
+        """Returns the position of the transaction with the given number, or
+        -1 if it is not in the table."""
+
+        numbers = self.columns['current']
+        index = bisect_left(numbers, number)
+        if index < len(numbers) and numbers[index] == number:
+            return index
+        return -1
+
+    def get(self, number):
+        """Returns the transaction with the given number, or None."""
+
+        index = self.find(number)
+        return self._make_transaction(index) if index >= 0 else None
+
+    def column(self, name):
+        """Returns the values of the given header field for all the rows: an
+        array for the integer fields and a list for the strings."""
+
+        if name in _INTERNED_FIELDS:
+            return [self.strings[index] for index in self.columns[name]]
+        if name == 'subject':
+            return list(self.subjects)
+        return self.columns[name]
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# This file measures the performance of the parts of the client which matter
+# for large meetings: encoding and decoding USP blocks, decoding transaction
+# headers, fetching headers and texts end-to-end (from the stand-in server in
+# discuss.server, over a socketpair), and reading and writing large .meetings
+# files.
+#
+# Every benchmark is run several times, and both the best and the median
+# time are reported; the best one is the least noisy. The inputs are
+# generated the same way every time, so the results of two runs on the same
+# machine can be compared. The results are written out as JSON; with
+# --compare, the times are also compared to the ones of an earlier run.
+#
+# The decoding of GET_ACL replies is measured at several sizes: the time
+# spent per entry should stay flat as the reply grows; if it grows with the
+# reply size, decoding has become quadratic again.
+#
+# Usage: tools/benchmark.py [--quick] [--repeat N] [--only NAME,...]
+#                           [--output FILE] [--compare FILE]
+
+import argparse, io, json, os, platform, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from discuss.rpc import USPBlock, USPReader
+from discuss.client import Client, Meeting, Transaction, _read_transaction
+from discuss.rcfile import RCFile
+from discuss.server import DiscussServer
+from discuss import constants, records
+
+_clock = getattr(time, "perf_counter", time.time)
+
+def measure(function, repeat):
+    """Runs the function repeat times and returns the list of times."""
+
+    times = []
+    for i in range(repeat):
+        start = _clock()
+        function()
+        times.append(_clock() - start)
+    return times
+
+def result(times, items = None, size = None):
+    """Summarizes the times of a benchmark into a dictionary."""
+
+    times = sorted(times)
+    best = times[0]
+    entry = { 'best' : best, 'median' : times[len(times) // 2], 'runs' : len(times) }
+    if items is not None:
+        entry['items'] = items
+        entry['usec_per_item'] = best / items * 1e6
+        entry['items_per_second'] = items / best if best else None
+    if size is not None:
+        entry['bytes'] = size
+        entry['mb_per_second'] = size / best / 1e6 if best else None
+    return entry
+
+def scaled(count, scale):
+    return max(1, int(count * scale))
+
+#
+# Inputs
+#
+
+def make_text(number, size):
+    """Text of the given size which differs between the transactions."""
+
+    line = "Line of the transaction %i, which is here to fill it up.\n" % number
+    return (line * (size // len(line) + 1))[:size]
+
+def make_trn_info(number):
+    """Header fields of a transaction, in the order of TRN_INFO_REPLY."""
+
+    return (0, number, number - 1, number + 1, 0, 0, number, number, 1,
+            1380000000 + number, 10, 500, "Subject of the transaction %i" % number,
+            "user%i@ATHENA.MIT.EDU" % (number % 100), 0, "User %i" % (number % 100), 0)
+
+def make_trn_info_blocks(count):
+    blocks = []
+    for number in range(1, count + 1):
+        block = USPBlock(constants.REPLY_TYPE)
+        records.TRN_INFO_REPLY.pack(block, *make_trn_info(number))
+        blocks.append(block)
+    return blocks
+
+def make_acl_reply(fields):
+    """Build a reply which looks like a large GET_ACL response."""
+
+    # Every entry is encoded separately and joined at the end, so that
+    # building the input does not dominate the run time
+    header = USPBlock(constants.REPLY_TYPE)
+    header.put_long_integer(0)
+    header.put_long_integer(fields)
+    parts = [header.buffer]
+    for i in range(fields):
+        entry = USPBlock(constants.REPLY_TYPE)
+        entry.put_string("acdorsw")
+        entry.put_string("user%i@ATHENA.MIT.EDU" % i)
+        parts.append(entry.buffer)
+    return b"".join(parts)
+
+def wire_data(blocks):
+    return b"".join(part.tobytes() if isinstance(part, memoryview) else bytes(part)
+                    for block in blocks for part in block.encode())
+
+class _Stream(object):
+    """Byte stream which USPReader can fill itself from."""
+
+    def __init__(self, data):
+        self.source = io.BytesIO(data)
+
+    def recv_into(self, buffer):
+        return self.source.readinto(buffer)
+
+def read_all_blocks(data, count):
+    reader = USPReader()
+    stream = _Stream(data)
+    for i in range(count):
+        reader.receive(stream)
+
+def make_server(count, text_size, **kwargs):
+    """Stand-in server with a meeting of count transactions."""
+
+    server = DiscussServer(**kwargs)
+    name = "/var/spool/discuss/benchmark"
+    server.create_meeting(name, "Benchmark")
+    for number in range(1, count + 1):
+        server.add_transaction(name, make_text(number, text_size), "Subject %i" % number,
+                reply_to = number - 1 if number % 10 else 0, date = 1380000000 + number)
+    return server, name
+
+def make_rcfile(location, count):
+    with open(location, "w") as target:
+        for i in range(count):
+            target.write("0:%i:%i:host%i.mit.edu:/var/spool/discuss/meeting%i:Meeting %i,meeting%i:\n" %
+                    (1380000000 + i, i * 7, i % 10, i, i, i))
+
+#
+# Benchmarks
+#
+
+def bench_usp_encode(scale, repeat):
+    blocks = make_trn_info_blocks(scaled(10000, scale))
+    def encode_small():
+        b"".join(part for block in blocks for part in block.encode())
+
+    large = USPBlock(constants.TFILE_BLK)
+    large.buffer = make_text(0, 1 << 20).encode()
+    rounds = scaled(20, scale)
+    def encode_large():
+        for i in range(rounds):
+            b"".join(large.encode())
+
+    return {
+        'usp_encode.small' : result(measure(encode_small, repeat), len(blocks), len(wire_data(blocks))),
+        'usp_encode.large' : result(measure(encode_large, repeat), rounds, rounds * len(large.buffer)),
+    }
+
+def bench_usp_decode(scale, repeat):
+    count = scaled(10000, scale)
+    small = wire_data(make_trn_info_blocks(count))
+
+    large_block = USPBlock(constants.TFILE_BLK)
+    large_block.buffer = make_text(0, 1 << 20).encode()
+    rounds = scaled(20, scale)
+    large = wire_data([large_block] * rounds)
+
+    return {
+        'usp_decode.small' : result(measure(lambda: read_all_blocks(small, count), repeat),
+                                    count, len(small)),
+        'usp_decode.large' : result(measure(lambda: read_all_blocks(large, rounds), repeat),
+                                    rounds, len(large)),
+    }
+
+def bench_acl_decode(scale, repeat):
+    results = {}
+    for fields in (1000, 10000, 100000):
+        fields = scaled(fields, scale)
+        data = make_acl_reply(fields)
+        def decode():
+            block = USPBlock(constants.REPLY_TYPE)
+            block.buffer = data
+            status, length = records.ACL_REPLY.unpack(block)
+            for i in range(length):
+                records.ACL_ENTRY.unpack(block)
+        results['acl_decode.%i' % fields] = result(measure(decode, repeat), fields, len(data))
+    return results
+
+def bench_receive_transaction(scale, repeat):
+    server, name = make_server(0, 0)
+    client = Client("benchmark", RPCClient = server.client_class())
+    meeting = Meeting(client, name)
+
+    count = scaled(20000, scale)
+    buffers = [bytes(block.buffer) for block in make_trn_info_blocks(count)]
+    def decode():
+        for buffer in buffers:
+            reply = USPBlock(constants.REPLY_TYPE)
+            reply.buffer = buffer
+            _read_transaction(meeting, reply, Transaction)
+
+    try:
+        return { 'receive_transaction' : result(measure(decode, repeat), count,
+                                                sum(len(buffer) for buffer in buffers)) }
+    finally:
+        client.close()
+        server.close()
+
+def bench_transactions(scale, repeat):
+    results = {}
+    for key, count, options in (("transactions", scaled(20000, scale), {}),
+                                ("transactions.latency_2ms", scaled(2000, scale), { 'latency' : 0.002 })):
+        server, name = make_server(count, 100, **options)
+        client = Client("benchmark", RPCClient = server.client_class())
+        meeting = Meeting(client, name)
+        try:
+            results[key] = result(measure(lambda: list(meeting.transactions(1, count)), repeat), count)
+        finally:
+            client.close()
+            server.close()
+    return results
+
+def bench_texts(scale, repeat):
+    count = scaled(5000, scale)
+    text_size = 2000
+    server, name = make_server(count, text_size)
+    client = Client("benchmark", RPCClient = server.client_class())
+    meeting = Meeting(client, name)
+    try:
+        times = measure(lambda: list(meeting.get_texts(1, count)), repeat)
+        return { 'texts' : result(times, count, count * text_size) }
+    finally:
+        client.close()
+        server.close()
+
+def bench_rcfile(scale, repeat):
+    count = scaled(50000, scale)
+    directory = tempfile.mkdtemp(prefix = "discuss-benchmark")
+    try:
+        location = os.path.join(directory, "meetings")
+        make_rcfile(location, count)
+        size = os.path.getsize(location)
+        rcfile = RCFile(location)
+        return {
+            'rcfile.load' : result(measure(rcfile.load, repeat), count, size),
+            'rcfile.save' : result(measure(rcfile.save, repeat), count, size),
+            'rcfile.recache' : result(measure(rcfile.recache, repeat), count),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+BENCHMARKS = (
+    ("usp_encode", bench_usp_encode),
+    ("usp_decode", bench_usp_decode),
+    ("acl_decode", bench_acl_decode),
+    ("receive_transaction", bench_receive_transaction),
+    ("transactions", bench_transactions),
+    ("texts", bench_texts),
+    ("rcfile", bench_rcfile),
+)
+
+def compare(baseline, results):
+    """Prints the ratio of the best times of this run to the ones of the
+    baseline run, for the benchmarks both have."""
+
+    print("%-28s %12s %12s %8s" % ("benchmark", "baseline", "current", "ratio"), file = sys.stderr)
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['best'], results[name]['best']
+        print("%-28s %12.6f %12.6f %8.3f" % (name, old, new, new / old if old else float('inf')),
+              file = sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure the performance of pydiscuss.")
+    parser.add_argument("--quick", action = "store_true", help = "run on inputs ten times smaller")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs of every benchmark")
+    parser.add_argument("--only", help = "comma-separated list of the benchmarks to run")
+    parser.add_argument("--output", help = "write the results into the file instead of stdout")
+    parser.add_argument("--compare", help = "results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    names = [name for name, function in BENCHMARKS]
+    selected = args.only.split(",") if args.only else names
+    for name in selected:
+        if name not in names:
+            parser.error("unknown benchmark %s (available: %s)" % (name, ", ".join(names)))
+
+    scale = 0.1 if args.quick else 1.0
+    results = {}
+    for name, function in BENCHMARKS:
+        if name in selected:
+            results.update(function(scale, args.repeat))
+
+    report = {
+        'meta' : {
+            'python' : platform.python_version(),
+            'implementation' : platform.python_implementation(),
+            'platform' : platform.platform(),
+            'time' : int(time.time()),
+            'scale' : scale,
+            'repeat' : args.repeat,
+        },
+        'results' : results,
+    }
+
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, "w") as target:
+            target.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, "r") as source:
+            compare(json.load(source)['results'], results)
+
+if __name__ == "__main__":
+    main()